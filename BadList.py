@@ -0,0 +1,118 @@
+# This module keeps the bad_videos, bad_sizes and bad_fastpreview lists in
+# memory. Each file is read into a set once and read again only when its
+# modification time changes (e.g. someone edited it by hand). New entries are
+# appended to the end of the file, and a background thread sorts the file
+# a little later so it stays in the same human-readable sorted format.
+# The key of a line is the text before the first ':' (the file name for
+# bad_videos and bad_fastpreview, the stamp for bad_sizes).
+
+import os
+import time
+import threading
+import logging
+import TCMConstants
+
+lists = {}
+lists_lock = threading.Lock()
+compact_event = threading.Event()
+compactor = None
+
+class BadList:
+
+	def __init__(self, path):
+		self.path = path
+		self.keys = set()
+		self.signature = None
+		self.dirty = False
+		self.lock = threading.Lock()
+
+	def __contains__(self, key):
+		with self.lock:
+			self.reload_if_changed()
+			return key in self.keys
+
+	def has_any(self, keys):
+		with self.lock:
+			self.reload_if_changed()
+			return any(key in self.keys for key in keys)
+
+	def add(self, key, line, log_message, log_level):
+		with self.lock:
+			self.reload_if_changed()
+			if key in self.keys:
+				return False
+			with open(self.path, "a") as writer:
+				writer.write(line)
+			self.keys.add(key)
+			self.signature = get_signature(self.path)
+			self.dirty = True
+		logging.getLogger(TCMConstants.get_basename()).log(log_level, log_message)
+		start_compactor()
+		compact_event.set()
+		return True
+
+	def reload_if_changed(self):
+		signature = get_signature(self.path)
+		if signature == self.signature:
+			return
+		self.keys = set()
+		if signature is not None:
+			with open(self.path, "r") as reader:
+				self.keys = set(get_key(line) for line in reader if line.strip())
+		self.signature = signature
+
+	def compact(self):
+		with self.lock:
+			if not self.dirty:
+				return
+			self.dirty = False
+			if not os.path.isfile(self.path):
+				return
+			with open(self.path, "r") as reader:
+				lines = {}
+				for line in reader:
+					if line.strip():
+						lines.setdefault(get_key(line), line if line.endswith("\n") else f"{line}\n")
+			with open(f"{self.path}.tmp", "w") as writer:
+				for line in sorted(lines.values()):
+					writer.write(line)
+			os.replace(f"{self.path}.tmp", self.path)
+			self.keys = set(lines)
+			self.signature = get_signature(self.path)
+
+def get_bad_list(path):
+	with lists_lock:
+		if path not in lists:
+			lists[path] = BadList(path)
+		return lists[path]
+
+def get_key(line):
+	return line.rstrip("\n").split(":", 1)[0]
+
+def get_signature(path):
+	try:
+		stat = os.stat(path)
+		return (stat.st_mtime_ns, stat.st_size)
+	except FileNotFoundError:
+		return None
+
+def start_compactor():
+	global compactor
+	with lists_lock:
+		if compactor is None:
+			compactor = threading.Thread(target=compact_lists, name="BadList compactor", daemon=True)
+			compactor.start()
+
+def compact_lists():
+	logger = logging.getLogger(TCMConstants.get_basename())
+	while True:
+		compact_event.wait()
+		compact_event.clear()
+		time.sleep(TCMConstants.BAD_LIST_COMPACT_DELAY)
+		with lists_lock:
+			pending = list(lists.values())
+		for bad_list in pending:
+			try:
+				bad_list.compact()
+			except OSError as e:
+				logger.error(f"Unable to sort {bad_list.path}: {e}")
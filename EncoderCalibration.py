@@ -0,0 +1,144 @@
+# This module picks the encoder settings for FFMPEG_ENCODER_PREFERENCE = 'auto'.
+# It encodes a short synthetic four-camera mosaic (lavfi testsrc2) with every
+# encoder ffmpeg offers on this machine (VAAPI, NVENC) and with a range of
+# libx264 presets and thread counts, and measures the frames per second of
+# each. A libx264 preset only counts if its output stays within
+# CALIBRATION_SIZE_BUDGET times the size of the smallest libx264 output, so
+# a faster preset is not picked just because it throws quality away. The
+# results are cached in CALIBRATION_CACHE_PATH, keyed by the ffmpeg version
+# and the CPU model, so the benchmark only runs again after one of them
+# changes.
+
+import os
+import json
+import time
+import tempfile
+import subprocess
+import multiprocessing
+import logging
+import TCMConstants
+
+VAAPI_DEVICE = '/dev/dri/renderD128'
+X264_PRESETS = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium']
+CALIBRATION_FPS = 36	# TeslaCam records at about 36 frames per second
+CAMERA_WIDTH = 1280
+CAMERA_HEIGHT = 960
+
+def get_calibration():
+	logger = logging.getLogger(TCMConstants.get_basename())
+	key = f"{get_ffmpeg_version()} | {get_cpu_model()}"
+	cache = read_cache()
+	if key in cache:
+		logger.info(f"Using cached encoder calibration: {cache[key]}")
+		return cache[key]
+	logger.info(f"Calibrating encoders for {key}, this takes a few minutes")
+	result = calibrate()
+	cache[key] = result
+	write_cache(cache)
+	logger.info(f"Encoder calibration result: {result}")
+	return result
+
+def calibrate():
+	logger = logging.getLogger(TCMConstants.get_basename())
+	encoders = get_encoders()
+	candidates = []
+	if 'h264_vaapi' in encoders and os.path.exists(VAAPI_DEVICE):
+		candidates.append({"encoder" : "h264_vaapi", "preset" : None, "threads" : 0})
+	if 'h264_nvenc' in encoders:
+		candidates.append({"encoder" : "h264_nvenc", "preset" : None, "threads" : 0})
+	for preset in X264_PRESETS:
+		for threads in get_thread_counts():
+			candidates.append({"encoder" : "libx264", "preset" : preset, "threads" : threads})
+
+	for candidate in candidates:
+		candidate["fps"], candidate["size"] = run_benchmark(candidate)
+		logger.info(f"Calibration: {candidate}")
+
+	x264 = [candidate for candidate in candidates if candidate["encoder"] == "libx264" and candidate["fps"]]
+	if x264:
+		smallest = min(candidate["size"] for candidate in x264)
+		x264 = [candidate for candidate in x264 if candidate["size"] <= smallest * TCMConstants.CALIBRATION_SIZE_BUDGET]
+		best_x264 = max(x264, key=lambda candidate: candidate["fps"])
+	else:
+		best_x264 = {"encoder" : "libx264", "preset" : None, "threads" : default_threads(), "fps" : 0, "size" : 0}
+	hardware = [candidate for candidate in candidates if candidate["encoder"] != "libx264" and candidate["fps"]]
+	best = max(hardware + [best_x264], key=lambda candidate: candidate["fps"])
+	return {"full" : best, "x264" : best_x264}
+
+def run_benchmark(candidate):
+	logger = logging.getLogger(TCMConstants.get_basename())
+	frames = TCMConstants.CALIBRATION_SECONDS * CALIBRATION_FPS
+	output = tempfile.NamedTemporaryFile(suffix=".mp4", delete=False)
+	output.close()
+	command = [TCMConstants.FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-y']
+	if candidate["encoder"] == "h264_vaapi":
+		command += ['-init_hw_device', f'vaapi=va:{VAAPI_DEVICE}', '-filter_hw_device', 'va']
+	for i in range(4):
+		command += ['-f', 'lavfi', '-i', f'testsrc2=size={CAMERA_WIDTH}x{CAMERA_HEIGHT}:rate={CALIBRATION_FPS}']
+	mosaic = (f'[1:v]scale=w={TCMConstants.FRONT_WIDTH}:h={TCMConstants.FRONT_HEIGHT}[top];'
+		f'[0:v]scale=w={TCMConstants.REST_WIDTH}:h={TCMConstants.REST_HEIGHT}[right];'
+		f'[3:v]scale=w={TCMConstants.REST_WIDTH}:h={TCMConstants.REST_HEIGHT}[back];'
+		f'[2:v]scale=w={TCMConstants.REST_WIDTH}:h={TCMConstants.REST_HEIGHT}[left];'
+		f'[left][back][right]hstack=inputs=3[bottom];[top][bottom]vstack=inputs=2')
+	if candidate["encoder"] == "h264_vaapi":
+		mosaic += ',format=nv12,hwupload'
+	command += ['-filter_complex', mosaic, '-frames:v', str(frames), '-c:v', candidate["encoder"]]
+	if candidate["preset"]:
+		command += ['-preset', candidate["preset"]]
+	command += ['-threads', str(candidate["threads"]), output.name]
+	try:
+		start = time.monotonic()
+		completed = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		elapsed = time.monotonic() - start
+		if completed.returncode != 0:
+			logger.debug(f"Calibration of {candidate} failed: {completed.stderr}")
+			return 0, 0
+		return round(frames / elapsed, 1), os.path.getsize(output.name)
+	finally:
+		os.remove(output.name)
+
+def get_encoders():
+	completed = subprocess.run([TCMConstants.FFMPEG_PATH, '-hide_banner', '-encoders'],
+		stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	return set(line.split()[1] for line in completed.stdout.decode("UTF-8").splitlines() if len(line.split()) > 1)
+
+def get_thread_counts():
+	cores = multiprocessing.cpu_count()
+	return sorted(set([default_threads(), max(1, cores // 2), cores]))
+
+def default_threads():
+	return max(1, (multiprocessing.cpu_count() // 2) - 1)
+
+def get_ffmpeg_version():
+	try:
+		completed = subprocess.run([TCMConstants.FFMPEG_PATH, '-version'],
+			stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		return completed.stdout.decode("UTF-8").splitlines()[0]
+	except (OSError, IndexError):
+		return "unknown ffmpeg"
+
+def get_cpu_model():
+	try:
+		with open("/proc/cpuinfo", "r") as cpuinfo:
+			for line in cpuinfo:
+				if line.startswith("model name") or line.startswith("Model"):
+					return f"{line.split(':', 1)[1].strip()} x{multiprocessing.cpu_count()}"
+	except OSError:
+		pass
+	return f"unknown CPU x{multiprocessing.cpu_count()}"
+
+def read_cache():
+	try:
+		with open(TCMConstants.CALIBRATION_CACHE_PATH, "r") as cache:
+			return json.load(cache)
+	except (OSError, ValueError):
+		return {}
+
+def write_cache(cache):
+	logger = logging.getLogger(TCMConstants.get_basename())
+	try:
+		with open(f"{TCMConstants.CALIBRATION_CACHE_PATH}.tmp", "w") as writer:
+			json.dump(cache, writer, indent=1)
+		os.replace(f"{TCMConstants.CALIBRATION_CACHE_PATH}.tmp", TCMConstants.CALIBRATION_CACHE_PATH)
+	except OSError as e:
+		logger.error(f"Unable to save encoder calibration to {TCMConstants.CALIBRATION_CACHE_PATH}: {e}")
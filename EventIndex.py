@@ -0,0 +1,100 @@
+# This module keeps an index of the event.json files in each Raw folder: a
+# sorted list of event timestamps (taken from the file names, as before) and
+# the reason, city and camera read from each file. The folder is listed
+# again only when its modification time changes, and only event files not
+# seen before are parsed. find() returns the event closest to a stamp
+# within EVENT_DURATION using a binary search.
+
+import os
+import json
+import bisect
+import datetime
+import threading
+import logging
+import TCMConstants
+
+EVENT_SUFFIX = f"-{TCMConstants.EVENT_JSON}"
+
+indexes = {}
+indexes_lock = threading.Lock()
+
+class EventIndex:
+
+	def __init__(self, path):
+		self.path = path
+		self.times = []
+		self.events = []
+		self.names = set()
+		self.mtime = None
+		self.lock = threading.Lock()
+
+	def refresh(self):
+		try:
+			mtime = os.stat(self.path).st_mtime_ns
+		except FileNotFoundError:
+			return
+		if mtime == self.mtime:
+			return
+		self.mtime = mtime
+		with os.scandir(self.path) as entries:
+			names = set(item.name for item in entries if item.name.endswith(EVENT_SUFFIX) and item.name != EVENT_SUFFIX)
+		for name in self.names - names:
+			self.remove(name)
+		for name in names - self.names:
+			self.add(name)
+
+	def add(self, name):
+		logger = logging.getLogger(TCMConstants.get_basename())
+		try:
+			event_time = datetime.datetime.strptime(name[:-len(EVENT_SUFFIX)], TCMConstants.FILENAME_TIMESTAMP_FORMAT)
+			with open(f"{self.path}/{name}", "r") as jsonfile:
+				event = json.load(jsonfile)
+		except (ValueError, OSError) as e:
+			logger.debug(f"Skipping event file {name}: {e}")
+			self.names.add(name)
+			return
+		position = bisect.bisect_right(self.times, event_time)
+		self.times.insert(position, event_time)
+		self.events.insert(position, {"name" : name,
+			"timestamp" : event.get('timestamp'),
+			"reason" : event.get('reason'),
+			"city" : event.get('city'),
+			"camera" : event.get('camera')})
+		self.names.add(name)
+
+	def remove(self, name):
+		self.names.discard(name)
+		for position, event in enumerate(self.events):
+			if event["name"] == name:
+				del self.times[position]
+				del self.events[position]
+				return
+
+	def find(self, stamp):
+		try:
+			stamp_time = datetime.datetime.strptime(stamp, TCMConstants.FILENAME_TIMESTAMP_FORMAT)
+		except ValueError:
+			return None
+		max_delta = datetime.timedelta(seconds=TCMConstants.EVENT_DURATION)
+		with self.lock:
+			self.refresh()
+			position = bisect.bisect_left(self.times, stamp_time)
+			candidates = [i for i in (position - 1, position) if 0 <= i < len(self.times)]
+			if not candidates:
+				return None
+			best = min(candidates, key=lambda i: abs(self.times[i] - stamp_time))
+			if abs(self.times[best] - stamp_time) <= max_delta:
+				return self.events[best]
+			return None
+
+	def get_names(self):
+		with self.lock:
+			self.refresh()
+			return [event["name"] for event in self.events]
+
+def get_event_index(folder):
+	path = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}"
+	with indexes_lock:
+		if path not in indexes:
+			indexes[path] = EventIndex(path)
+		return indexes[path]
@@ -0,0 +1,139 @@
+# This module runs ffmpeg without a shell and follows its progress. ffmpeg
+# is started with "-progress pipe:1", and the frame, fps, speed and out_time
+# values it reports are kept per job, logged every
+# FFMPEG_PROGRESS_LOG_INTERVAL seconds and written to FFMPEG_PROGRESS_PATH so
+# Stats can show the encodes in flight. A job whose frame count has not moved
+# for FFMPEG_STALL_TIMEOUT seconds of wall-clock time is killed, instead of
+# waiting for FFMPEG_TIMELIMIT seconds of CPU time. Wall and CPU seconds,
+# frames and results are counted per job type in Metrics.
+
+import os
+import json
+import signal
+import time
+import asyncio
+import threading
+import subprocess
+import logging
+import TCMConstants
+import Metrics
+
+jobs = {}
+jobs_lock = threading.Lock()
+last_write = 0
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+def run(argv, key, description, job_type):
+	# Returns (returncode, stdout, stderr, stalled), like subprocess.run would
+	return asyncio.run(run_async(argv, key, description, job_type))
+
+async def run_async(argv, key, description, job_type):
+	logger = logging.getLogger(TCMConstants.get_basename())
+	command = argv[:1] + ['-nostats', '-progress', 'pipe:1'] + argv[1:]
+	process = await asyncio.create_subprocess_exec(*command, stdin=subprocess.DEVNULL,
+		stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+	progress = {"description" : description, "started" : time.time(), "frame" : 0,
+		"fps" : 0.0, "speed" : "", "out_time" : ""}
+	with jobs_lock:
+		jobs[key] = progress
+	write_progress(force=True)
+	stderr_task = asyncio.ensure_future(process.stderr.read())
+	stalled = False
+	returncode = None
+	last_advance = last_log = started = time.monotonic()
+	cpu_seconds = 0
+	output = []
+	try:
+		while True:
+			remaining = TCMConstants.FFMPEG_STALL_TIMEOUT - (time.monotonic() - last_advance)
+			try:
+				line = await asyncio.wait_for(process.stdout.readline(), max(remaining, 0.1))
+			except asyncio.TimeoutError:
+				stalled = True
+				logger.error(f"{description} stalled for {TCMConstants.FFMPEG_STALL_TIMEOUT} seconds at frame {progress['frame']}, killing ffmpeg")
+				kill(process)
+				break
+			if not line:
+				break
+			output.append(line)
+			name, _, value = line.decode("UTF-8", "replace").strip().partition("=")
+			if name == "frame":
+				frame = int(value) if value.isdigit() else progress["frame"]
+				if frame != progress["frame"]:
+					last_advance = time.monotonic()
+					Metrics.inc("tcm_ffmpeg_frames_total", frame - progress["frame"], type=job_type)
+				progress["frame"] = frame
+			elif name == "fps":
+				try:
+					progress["fps"] = float(value)
+				except ValueError:
+					pass
+			elif name in ("speed", "out_time"):
+				progress[name] = value
+			elif name == "progress":
+				# ffmpeg is still there when it reports, so its CPU time can be read
+				cpu_seconds = get_cpu_seconds(process.pid) or cpu_seconds
+				write_progress()
+				if time.monotonic() - last_log >= TCMConstants.FFMPEG_PROGRESS_LOG_INTERVAL:
+					last_log = time.monotonic()
+					logger.info(f"{description}: frame {progress['frame']}, {progress['fps']} fps, speed {progress['speed']}, at {progress['out_time']}")
+		returncode = await process.wait()
+		stderr = await stderr_task
+	finally:
+		with jobs_lock:
+			jobs.pop(key, None)
+		write_progress(force=True)
+		record_metrics(job_type, progress["frame"], time.monotonic() - started, cpu_seconds, returncode, stalled)
+	return returncode, b"".join(output), stderr, stalled
+
+def kill(process):
+	# ffmpeg runs in its own session, so this also stops anything it started
+	try:
+		os.killpg(process.pid, signal.SIGKILL)
+	except ProcessLookupError:
+		pass
+
+def get_cpu_seconds(pid):
+	# utime and stime of the process and its waited-for children, from /proc/<pid>/stat
+	try:
+		with open(f"/proc/{pid}/stat", "r") as reader:
+			fields = reader.read().rsplit(")", 1)[1].split()
+		return sum(int(value) for value in fields[11:15]) / CLOCK_TICKS
+	except (OSError, IndexError, ValueError):
+		return None
+
+def record_metrics(job_type, frames, wall_seconds, cpu_seconds, returncode, stalled):
+	result = "stalled" if stalled else "ok" if returncode == 0 else "failed"
+	Metrics.inc("tcm_ffmpeg_jobs_total", type=job_type, result=result)
+	Metrics.observe("tcm_ffmpeg_wall_seconds", wall_seconds, type=job_type)
+	Metrics.inc("tcm_ffmpeg_cpu_seconds_total", cpu_seconds, type=job_type)
+	if wall_seconds > 0 and frames > 0:
+		Metrics.set_gauge("tcm_ffmpeg_fps", round(frames / wall_seconds, 2), type=job_type)
+
+def get_jobs():
+	with jobs_lock:
+		return {key : dict(progress) for key, progress in jobs.items()}
+
+def write_progress(force=False):
+	global last_write
+	if not TCMConstants.FFMPEG_PROGRESS_PATH:
+		return
+	with jobs_lock:
+		if not force and time.time() - last_write < TCMConstants.FFMPEG_PROGRESS_WRITE_INTERVAL:
+			return
+		last_write = time.time()
+		snapshot = {"updated" : last_write, "pid" : os.getpid(), "jobs" : {key : dict(progress) for key, progress in jobs.items()}}
+		try:
+			with open(f"{TCMConstants.FFMPEG_PROGRESS_PATH}.tmp", "w") as writer:
+				json.dump(snapshot, writer)
+			os.replace(f"{TCMConstants.FFMPEG_PROGRESS_PATH}.tmp", TCMConstants.FFMPEG_PROGRESS_PATH)
+		except OSError as e:
+			logging.getLogger(TCMConstants.get_basename()).debug(f"Unable to write {TCMConstants.FFMPEG_PROGRESS_PATH}: {e}")
+
+def read_progress():
+	try:
+		with open(TCMConstants.FFMPEG_PROGRESS_PATH, "r") as reader:
+			return json.load(reader)
+	except (OSError, ValueError, TypeError):
+		return {"updated" : 0, "jobs" : {}}
@@ -0,0 +1,244 @@
+# This module keeps a SQLite catalog of every stamp in the footage folders
+# so the services do not have to rediscover the whole tree on every loop.
+# Each row is one stamp in one footage folder ("SentryClips", or
+# "Car1/SentryClips" with MULTI_CAR) and holds the raw file sizes, the merge
+# state, the full and fast output paths, the event metadata and the date
+# after which RemoveOld will have deleted everything for that stamp.
+# LoadSSD, MergeTeslaCam and RemoveOld update the catalog as they work and
+# reconcile() fixes any drift against the filesystem. Only MergeTeslaCam
+# reads it to decide what to do. Files the catalog does not track (event
+# videos, bad lists, anything added by hand) mean that RemoveOld and Stats
+# still look at the folders themselves.
+
+import os
+import json
+import sqlite3
+import datetime
+import threading
+import logging
+import TCMConstants
+
+CAMERA_COLUMNS = {
+	TCMConstants.FRONT_TEXT : 'front_size',
+	TCMConstants.LEFT_TEXT : 'left_size',
+	TCMConstants.RIGHT_TEXT : 'right_size',
+	TCMConstants.BACK_TEXT : 'back_size'
+}
+OUTPUT_COLUMNS = {
+	TCMConstants.FULL_FOLDER : ('full_path', TCMConstants.FULL_TEXT),
+	TCMConstants.FAST_FOLDER : ('fast_path', TCMConstants.FAST_TEXT)
+}
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS stamps (
+	folder TEXT NOT NULL,
+	stamp TEXT NOT NULL,
+	front_size INTEGER,
+	left_size INTEGER,
+	right_size INTEGER,
+	back_size INTEGER,
+	has_event INTEGER NOT NULL DEFAULT 0,
+	state TEXT NOT NULL DEFAULT 'incomplete',
+	full_path TEXT,
+	fast_path TEXT,
+	event_reason TEXT,
+	event_city TEXT,
+	event_camera TEXT,
+	event_timestamp TEXT,
+	expires TEXT,
+	PRIMARY KEY (folder, stamp))"""
+# The member stamps each stitched event file was last made from
+STITCH_SCHEMA = """CREATE TABLE IF NOT EXISTS stitches (
+	folder TEXT NOT NULL,
+	output TEXT NOT NULL,
+	members TEXT NOT NULL,
+	PRIMARY KEY (folder, output))"""
+STATE_INDEX = "CREATE INDEX IF NOT EXISTS stamps_state ON stamps (folder, state)"
+EXPIRES_INDEX = "CREATE INDEX IF NOT EXISTS stamps_expires ON stamps (expires)"
+
+local = threading.local()
+
+def connect():
+	connection = getattr(local, "connection", None)
+	if connection is None:
+		connection = sqlite3.connect(TCMConstants.CATALOG_PATH, timeout=30, isolation_level=None)
+		connection.row_factory = sqlite3.Row
+		connection.execute("PRAGMA journal_mode=WAL")
+		connection.execute(SCHEMA)
+		connection.execute(STITCH_SCHEMA)
+		connection.execute(STATE_INDEX)
+		connection.execute(EXPIRES_INDEX)
+		local.connection = connection
+	return connection
+
+### Updates ###
+
+def record_raw_file(folder, name, size):
+	try:
+		stamp, camera = name.rsplit("-", 1)
+	except ValueError:
+		return
+	if camera in CAMERA_COLUMNS:
+		ensure_stamp(folder, stamp)
+		connect().execute(f"UPDATE stamps SET {CAMERA_COLUMNS[camera]} = ? WHERE folder = ? AND stamp = ?",
+			(size, folder, stamp))
+	elif camera == TCMConstants.EVENT_JSON:
+		ensure_stamp(folder, stamp)
+		event = read_event(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{name}")
+		connect().execute("UPDATE stamps SET has_event = 1, event_reason = ?, event_city = ?, event_camera = ?, event_timestamp = ? WHERE folder = ? AND stamp = ?",
+			(event.get('reason'), event.get('city'), event.get('camera'), event.get('timestamp'), folder, stamp))
+
+def record_output(folder, stamp, video_folder, path):
+	column = OUTPUT_COLUMNS[video_folder][0]
+	ensure_stamp(folder, stamp)
+	connect().execute(f"UPDATE stamps SET {column} = ? WHERE folder = ? AND stamp = ?", (path, folder, stamp))
+
+def set_state(folder, stamp, state):
+	connect().execute("UPDATE stamps SET state = ? WHERE folder = ? AND stamp = ? AND state != ?",
+		(state, folder, stamp, state))
+
+def forget_file(folder, video_folder, name):
+	try:
+		stamp, suffix = name.rsplit("-", 1)
+	except ValueError:
+		return
+	connection = connect()
+	if video_folder == TCMConstants.RAW_FOLDER:
+		if suffix in CAMERA_COLUMNS:
+			connection.execute(f"UPDATE stamps SET {CAMERA_COLUMNS[suffix]} = NULL WHERE folder = ? AND stamp = ?", (folder, stamp))
+		elif suffix == TCMConstants.EVENT_JSON:
+			connection.execute("UPDATE stamps SET has_event = 0 WHERE folder = ? AND stamp = ?", (folder, stamp))
+	elif video_folder in OUTPUT_COLUMNS and suffix == OUTPUT_COLUMNS[video_folder][1]:
+		connection.execute(f"UPDATE stamps SET {OUTPUT_COLUMNS[video_folder][0]} = NULL WHERE folder = ? AND stamp = ?", (folder, stamp))
+	connection.execute("""DELETE FROM stamps WHERE folder = ? AND stamp = ? AND has_event = 0
+		AND front_size IS NULL AND left_size IS NULL AND right_size IS NULL AND back_size IS NULL
+		AND full_path IS NULL AND fast_path IS NULL""", (folder, stamp))
+
+def set_stitch_members(folder, output, stamps):
+	connect().execute("INSERT OR REPLACE INTO stitches (folder, output, members) VALUES (?, ?, ?)",
+		(folder, output, json.dumps(sorted(stamps))))
+
+def ensure_stamp(folder, stamp):
+	connect().execute("INSERT OR IGNORE INTO stamps (folder, stamp, expires) VALUES (?, ?, ?)",
+		(folder, stamp, get_expiry(folder, stamp)))
+
+### Queries ###
+
+def get_stamps(folder, exclude_states=()):
+	query = "SELECT * FROM stamps WHERE folder = ?"
+	parameters = [folder]
+	if exclude_states:
+		query += f" AND state NOT IN ({', '.join('?' for state in exclude_states)})"
+		parameters.extend(exclude_states)
+	return {row['stamp'] : dict(row) for row in connect().execute(query, parameters)}
+
+def get_stamp(folder, stamp):
+	row = connect().execute("SELECT * FROM stamps WHERE folder = ? AND stamp = ?", (folder, stamp)).fetchone()
+	return dict(row) if row else None
+
+def get_stamps_between(folder, first, last):
+	# Stamp names sort in time order, so this is a range of the primary key
+	query = "SELECT * FROM stamps WHERE folder = ? AND stamp BETWEEN ? AND ?"
+	return {row['stamp'] : dict(row) for row in connect().execute(query, (folder, first, last))}
+
+def get_stitch_members(folder, output):
+	row = connect().execute("SELECT members FROM stitches WHERE folder = ? AND output = ?", (folder, output)).fetchone()
+	return json.loads(row['members']) if row else []
+
+def get_camera_sizes(row):
+	return {camera : row[column] for camera, column in CAMERA_COLUMNS.items() if row[column] is not None}
+
+### Reconciliation ###
+
+def reconcile(folder):
+	# Rebuild the rows for one footage folder from what is actually on disk:
+	# new stamps are added, sizes and output paths are corrected, and rows
+	# whose files are all gone are dropped.
+	logger = logging.getLogger(TCMConstants.get_basename())
+	found = {}
+	raw_path = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}"
+	for item in scan(raw_path):
+		try:
+			stamp, camera = item.name.rsplit("-", 1)
+		except ValueError:
+			continue
+		if camera in CAMERA_COLUMNS:
+			try:
+				found.setdefault(stamp, {})[CAMERA_COLUMNS[camera]] = item.stat().st_size
+			except FileNotFoundError:
+				continue
+		elif camera == TCMConstants.EVENT_JSON:
+			found.setdefault(stamp, {})['has_event'] = 1
+	for video_folder, (column, text) in OUTPUT_COLUMNS.items():
+		output_path = f"{TCMConstants.FOOTAGE_PATH}{folder}/{video_folder}"
+		for item in scan(output_path):
+			if item.name.endswith(f"-{text}"):
+				found.setdefault(item.name[:-len(text) - 1], {})[column] = f"{output_path}/{item.name}"
+
+	existing = get_stamps(folder)
+	columns = list(CAMERA_COLUMNS.values()) + ['has_event'] + [column for column, text in OUTPUT_COLUMNS.values()]
+	connection = connect()
+	added = changed = removed = 0
+	connection.execute("BEGIN")
+	try:
+		for stamp, values in found.items():
+			values.setdefault('has_event', 0)
+			row = existing.get(stamp)
+			if row and all(row[column] == values.get(column) for column in columns):
+				continue
+			if row:
+				changed += 1
+			else:
+				added += 1
+				connection.execute("INSERT INTO stamps (folder, stamp, expires) VALUES (?, ?, ?)",
+					(folder, stamp, get_expiry(folder, stamp)))
+			state = get_disk_state(values)
+			connection.execute(f"UPDATE stamps SET {', '.join(f'{column} = ?' for column in columns)}, state = ? WHERE folder = ? AND stamp = ?",
+				[values.get(column) for column in columns] + [state, folder, stamp])
+			if values['has_event'] and not (row and row['has_event']):
+				event = read_event(f"{raw_path}/{stamp}-{TCMConstants.EVENT_JSON}")
+				connection.execute("UPDATE stamps SET event_reason = ?, event_city = ?, event_camera = ?, event_timestamp = ? WHERE folder = ? AND stamp = ?",
+					(event.get('reason'), event.get('city'), event.get('camera'), event.get('timestamp'), folder, stamp))
+		for stamp in existing:
+			if stamp not in found:
+				removed += 1
+				connection.execute("DELETE FROM stamps WHERE folder = ? AND stamp = ?", (folder, stamp))
+		connection.execute("COMMIT")
+	except:
+		connection.execute("ROLLBACK")
+		raise
+	logger.info(f"Catalog reconciled for {folder}: {added} added, {changed} corrected, {removed} removed")
+
+def get_disk_state(values):
+	if values.get('full_path') and values.get('fast_path'):
+		return 'previewed'
+	elif values.get('full_path'):
+		return 'merged'
+	else:
+		return 'incomplete'
+
+### Utility functions ###
+
+def scan(path):
+	try:
+		with os.scandir(path) as entries:
+			return list(entries)
+	except FileNotFoundError:
+		return []
+
+def read_event(path):
+	try:
+		with open(path, "r") as jsonfile:
+			return json.load(jsonfile)
+	except Exception as e:
+		logging.getLogger(TCMConstants.get_basename()).debug(f"Unable to read event file {path}: {e}")
+		return {}
+
+def get_expiry(folder, stamp):
+	try:
+		timestamp = datetime.datetime.strptime(stamp, TCMConstants.FILENAME_TIMESTAMP_FORMAT)
+	except ValueError:
+		return None
+	footage_folder = folder.rsplit("/", 1)[-1]
+	days = max(TCMConstants.get_days_to_keep(footage_folder, video_folder)
+		for video_folder in [TCMConstants.RAW_FOLDER, TCMConstants.FULL_FOLDER, TCMConstants.FAST_FOLDER])
+	return (timestamp + datetime.timedelta(days=days + 1)).strftime(TCMConstants.FILENAME_TIMESTAMP_FORMAT)
@@ -0,0 +1,174 @@
+# This module copies files from the share to the SSD for LoadSSD with
+# INGEST_WORKERS copies running at the same time. A file on the same
+# filesystem is simply renamed. Otherwise it is copied in the kernel
+# (copy_file_range, or sendfile where that is not supported) into a ".part"
+# file next to the destination, checked against the size of the source (and
+# its hash with INGEST_VERIFY_HASH), and renamed into place. Finished copies
+# are made durable in groups of up to INGEST_FSYNC_BATCH, and the sources are
+# only deleted after that.
+
+import os
+import errno
+import hashlib
+import threading
+import logging
+import TCMConstants
+import Metrics
+from WorkerPool import WorkerPool
+
+COPY_CHUNK = 8 * 1024 * 1024
+PART_SUFFIX = ".part"
+
+pool = None
+pending = []
+# Sources of the group being flushed, until they have been deleted
+committing = set()
+pending_lock = threading.Lock()
+commit_lock = threading.Lock()
+
+def submit(source, destination, on_ingested, *args):
+	# on_ingested(destination, *args) runs once the file is in place under its final name
+	global pool
+	if pool is None:
+		pool = WorkerPool("Ingest", TCMConstants.INGEST_WORKERS)
+	return pool.submit(source, 0, ingest_file, source, destination, on_ingested, args)
+
+def is_busy(source):
+	# Also true while the copy waits for its group to be flushed, and until
+	# its source has been deleted
+	with pending_lock:
+		if source in committing or any(pending_source == source for pending_source, destination in pending):
+			return True
+	return pool is not None and pool.has(source)
+
+def is_same_size(source, destination):
+	try:
+		return os.path.getsize(source) == os.path.getsize(destination)
+	except OSError:
+		return False
+
+def ingest_file(source, destination, on_ingested, args):
+	try:
+		move_file(source, destination, on_ingested, args)
+	finally:
+		# Whether or not this file made it, the copies that finished before
+		# it must not wait for a group that may never fill up
+		with pending_lock:
+			commit_now = pending and (len(pending) >= TCMConstants.INGEST_FSYNC_BATCH or pool.queued() == 0)
+		if commit_now:
+			commit()
+
+def move_file(source, destination, on_ingested, args):
+	logger = logging.getLogger(TCMConstants.get_basename())
+	try:
+		os.rename(source, destination)
+		logger.debug(f"Renamed {source} to {destination}")
+		count_ingested(destination, "rename")
+		on_ingested(destination, *args)
+		return
+	except OSError as e:
+		if e.errno != errno.EXDEV:
+			raise
+
+	partial = f"{destination}{PART_SUFFIX}"
+	try:
+		copy_file(source, partial)
+		if not copy_is_verified(source, partial):
+			logger.error(f"Copy of {source} does not match the source, will try again")
+			os.remove(partial)
+			return
+		os.rename(partial, destination)
+	except OSError:
+		try:
+			os.remove(partial)
+		except OSError:
+			pass
+		raise
+	logger.debug(f"Copied {source} to {destination}")
+	count_ingested(destination, "copy")
+	with pending_lock:
+		pending.append((source, destination))
+	on_ingested(destination, *args)
+
+def count_ingested(destination, method):
+	try:
+		Metrics.inc("tcm_ingest_bytes_total", os.path.getsize(destination), method=method)
+	except OSError:
+		pass
+	Metrics.inc("tcm_ingest_files_total", method=method)
+
+def copy_file(source, destination):
+	with open(source, "rb") as reader, open(destination, "wb") as writer:
+		size = os.fstat(reader.fileno()).st_size
+		offset = 0
+		use_copy_file_range = hasattr(os, "copy_file_range")
+		while offset < size:
+			try:
+				if use_copy_file_range:
+					copied = os.copy_file_range(reader.fileno(), writer.fileno(), min(COPY_CHUNK, size - offset), offset, offset)
+				else:
+					copied = os.sendfile(writer.fileno(), reader.fileno(), offset, min(COPY_CHUNK, size - offset))
+			except OSError as e:
+				# CIFS to ext4 can refuse copy_file_range; sendfile reads into the page cache instead
+				if use_copy_file_range and offset == 0 and e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+					use_copy_file_range = False
+					continue
+				raise
+			if copied == 0:
+				break
+			offset += copied
+
+def copy_is_verified(source, destination):
+	if os.path.getsize(source) != os.path.getsize(destination):
+		return False
+	if TCMConstants.INGEST_VERIFY_HASH:
+		return get_hash(source) == get_hash(destination)
+	return True
+
+def get_hash(path):
+	digest = hashlib.blake2b()
+	with open(path, "rb") as reader:
+		for block in iter(lambda: reader.read(COPY_CHUNK), b""):
+			digest.update(block)
+	return digest.hexdigest()
+
+def commit():
+	# Flush a group of finished copies and their directories to disk, then
+	# delete their sources from the share
+	logger = logging.getLogger(TCMConstants.get_basename())
+	with commit_lock:
+		with pending_lock:
+			batch = pending[:]
+			del pending[:]
+			committing.update(source for source, destination in batch)
+		if not batch:
+			return
+		try:
+			for source, destination in batch:
+				fsync_path(destination, os.O_RDONLY)
+			for directory in set(os.path.dirname(destination) for source, destination in batch):
+				fsync_path(directory, os.O_RDONLY | os.O_DIRECTORY)
+			for source, destination in batch:
+				remove_source(source)
+		finally:
+			with pending_lock:
+				committing.difference_update(source for source, destination in batch)
+		logger.info(f"Ingested {len(batch)} files")
+
+def remove_source(source):
+	try:
+		os.remove(source)
+	except FileNotFoundError:
+		pass
+	except OSError as e:
+		logging.getLogger(TCMConstants.get_basename()).error(f"Unable to remove {source} after copying it: {e}")
+
+def fsync_path(path, flags):
+	try:
+		descriptor = os.open(path, flags)
+	except FileNotFoundError:
+		return
+	try:
+		os.fsync(descriptor)
+	finally:
+		os.close(descriptor)
@@ -0,0 +1,119 @@
+# This module lets the services sleep until something changes in the folders
+# they care about, using Linux inotify through ctypes. wait() returns the set
+# of directories that saw a file written, moved in or created, or None when
+# a full scan is due: the timeout ran out, the kernel queue overflowed, or
+# inotify is not available (in which case it falls back to sleeping for
+# SLEEP_DURATION like the timed loops always did).
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import TCMConstants
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+class Watcher:
+
+	def __init__(self, paths, recursive=False):
+		self.logger = logging.getLogger(TCMConstants.get_basename())
+		self.recursive = recursive
+		self.watches = {}
+		self.fd = -1
+		if not TCMConstants.EVENT_DRIVEN:
+			return
+		try:
+			self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+			self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		except (OSError, AttributeError) as e:
+			self.logger.warning(f"inotify not available, falling back to polling: {e}")
+			return
+		if self.fd < 0:
+			self.logger.warning(f"inotify_init1 failed, falling back to polling: {os.strerror(ctypes.get_errno())}")
+			return
+		for path in paths:
+			self.add_watch(path.rstrip("/"))
+
+	def add_watch(self, path):
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+		if wd < 0:
+			self.logger.warning(f"Unable to watch {path}: {os.strerror(ctypes.get_errno())}")
+			return
+		self.watches[wd] = path
+		if self.recursive:
+			try:
+				with os.scandir(path) as entries:
+					for item in entries:
+						if item.is_dir(follow_symlinks=False):
+							self.add_watch(item.path)
+			except OSError as e:
+				self.logger.debug(f"Unable to list {path} for watches: {e}")
+
+	def wait(self, timeout):
+		if self.fd < 0:
+			time.sleep(TCMConstants.SLEEP_DURATION)
+			return None
+		readable, _, _ = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return None
+		changed = set()
+		# Let a burst of writes settle so one wake-up handles all of it, but
+		# return after INOTIFY_SETTLE_MAX even if the events keep coming
+		deadline = time.monotonic() + TCMConstants.INOTIFY_SETTLE_MAX
+		while readable:
+			if not self.read_events(changed):
+				return None
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				break
+			readable, _, _ = select.select([self.fd], [], [], min(TCMConstants.INOTIFY_SETTLE, remaining))
+		self.logger.debug(f"Changes in: {changed}")
+		return changed
+
+	def read_events(self, changed):
+		try:
+			data = os.read(self.fd, 65536)
+		except OSError as e:
+			if e.errno == errno.EAGAIN:
+				return True
+			raise
+		offset = 0
+		while offset < len(data):
+			wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+			name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+			offset += EVENT_HEADER.size + length
+			if mask & IN_Q_OVERFLOW:
+				self.logger.warning("inotify queue overflowed, doing a full scan")
+				return False
+			path = self.watches.get(wd)
+			if mask & IN_IGNORED:
+				self.watches.pop(wd, None)
+				continue
+			if path is None or mask & IN_DELETE_SELF:
+				continue
+			changed.add(path)
+			if self.recursive and mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+				child = os.path.join(path, os.fsdecode(name))
+				self.add_watch(child)
+				changed.add(child)
+		return True
+
+	def close(self):
+		if self.fd >= 0:
+			os.close(self.fd)
+			self.fd = -1
@@ -5,17 +5,40 @@
 # cars in CAR_LIST. I use it to pick up files placed in a CIFS share by
 # teslausb and move them to a location for merging and viewing.
 # Enhanced to copy event.mp4 files
+# Every file moved is recorded in the footage catalog (FootageCatalog).
+# With EVENT_DRIVEN set, only the share directories that inotify reports
+# as changed are looked at, plus a full walk every FULL_SCAN_INTERVAL.
+# The copies themselves run in parallel in Ingest. Once all four cameras of a
+# stamp are in Raw, the stamp is handed to MergeTeslaCam through Spool.
 
 import os
 import time
-import shutil
 import re
 import json
 import TCMConstants
+import FootageCatalog
+import Inotify
+import Ingest
+import Spool
+import Metrics
+import threading
 import datetime
 
 logger = TCMConstants.get_logger()
 
+# Share directories seen in the last full scan, as path: ((inode, mtime),
+# subdirectories), the directories that still had files to move, and the
+# (size, mtime) of those files
+directory_cache = {}
+pending_directories = set()
+file_states = {}
+
+# Share directories whose event.json has been moved, and the stamps of event
+# directories that wait for it before they are handed to MergeTeslaCam
+handoff_lock = threading.Lock()
+events_moved = set()
+waiting_for_event = {}
+
 def main():
     if len(TCMConstants.SHARE_PATHS) <= 0:
             logger.error("No share paths defined, please fix in TCMConstants.py and restart.")
@@ -24,22 +47,21 @@ def main():
             logger.error("Missing some required permissions, exiting")
             TCMConstants.exit_gracefully(TCMConstants.SPECIAL_EXIT_CODE, None)
 
+    watcher = Inotify.Watcher(
+            [f"{share}{folder}" for share in TCMConstants.SHARE_PATHS for folder in TCMConstants.FOOTAGE_FOLDERS],
+            recursive=True)
+    changed = None
     while True:
-            for index, share in enumerate(TCMConstants.SHARE_PATHS):
-                    for folder in TCMConstants.FOOTAGE_FOLDERS:
-                            for root, dirs, files in os.walk(f"{share}{folder}", topdown=False):
-                                    logger.debug(f"Checking share path: {share}{folder}")
-                                    logger.debug(f"Files in {root}: {files}")
-                                    for name in files:
-                                            if file_has_proper_name(name):
-                                                    sub_path = folder
-                                                    if TCMConstants.MULTI_CAR:
-                                                            sub_path = f"{TCMConstants.CAR_LIST[index]}/{folder}"
-                                                    move_file(os.path.join(root, name), sub_path, name, root)
-                                            elif name != "thumb.png":
-                                                    logger.warning(f"File '{name}' has invalid name, skipping")
-
-            time.sleep(TCMConstants.SLEEP_DURATION)
+            Metrics.timed_call("tcm_open_files_scan_seconds", TCMConstants.refresh_open_files)
+            if changed is None:
+                    full_scan()
+            else:
+                    for root in changed | pending_directories:
+                            scan_directory(root)
+
+            Metrics.write(force=True)
+            # Files that could not be moved yet are tried again sooner
+            changed = watcher.wait(TCMConstants.SLEEP_DURATION if pending_directories else TCMConstants.FULL_SCAN_INTERVAL)
 
 ### Startup functions ###
 
@@ -55,13 +77,105 @@ def have_required_permissions():
                                 f"{TCMConstants.FOOTAGE_PATH}{sub_path}/{TCMConstants.RAW_FOLDER}", True)
                         have_perms = have_perms and TCMConstants.check_permissions(
                                 f"{TCMConstants.FOOTAGE_PATH}{sub_path}/{TCMConstants.FULL_FOLDER}", True)
+        if TCMConstants.SPOOL_PATH:
+                have_perms = have_perms and TCMConstants.check_permissions(TCMConstants.SPOOL_PATH, True)
         return have_perms
 
 ### Loop functions ###
 
+def full_scan():
+        global directory_cache
+        visited = {}
+        for index, share in enumerate(TCMConstants.SHARE_PATHS):
+                for folder in TCMConstants.FOOTAGE_FOLDERS:
+                        logger.debug(f"Checking share path: {share}{folder}")
+                        scan_tree(f"{share}{folder}", get_sub_path(index, folder), visited)
+        directory_cache = visited
+        for path in [path for path in pending_directories if path not in visited]:
+                pending_directories.discard(path)
+        for file in [file for file in file_states if os.path.dirname(file) not in pending_directories]:
+                del file_states[file]
+        with handoff_lock:
+                events_moved.intersection_update(visited)
+                for root in [root for root in waiting_for_event if root not in visited]:
+                        del waiting_for_event[root]
+
+def scan_tree(path, sub_path, visited):
+        # A directory whose inode and mtime are unchanged has the same entries
+        # as last time, so it is not listed again unless files were left in it
+        try:
+                stat = os.stat(path)
+        except FileNotFoundError:
+                return
+        signature = (stat.st_ino, stat.st_mtime_ns)
+        cached = directory_cache.get(path)
+        if cached and cached[0] == signature and path not in pending_directories:
+                subdirectories = cached[1]
+                files = None
+        else:
+                try:
+                        with os.scandir(path) as entries:
+                                entries = list(entries)
+                except FileNotFoundError:
+                        return
+                subdirectories = [item.path for item in entries if item.is_dir(follow_symlinks=False)]
+                files = [item.name for item in entries if item.is_file(follow_symlinks=False)]
+        visited[path] = (signature, subdirectories)
+        # Deepest directories first, as with the bottom-up walk before
+        for subdirectory in subdirectories:
+                scan_tree(subdirectory, sub_path, visited)
+        if files is not None:
+                process_files(path, files, sub_path)
+
+def scan_directory(root):
+        for index, share in enumerate(TCMConstants.SHARE_PATHS):
+                for folder in TCMConstants.FOOTAGE_FOLDERS:
+                        if root == f"{share}{folder}" or root.startswith(f"{share}{folder}/"):
+                                try:
+                                        files = [item.name for item in os.scandir(root) if item.is_file(follow_symlinks=False)]
+                                except FileNotFoundError:
+                                        pending_directories.discard(root)
+                                        return
+                                process_files(root, files, get_sub_path(index, folder))
+                                return
+
+def process_files(root, files, sub_path):
+        if files:
+                logger.debug(f"Files in {root}: {files}")
+        left = False
+        for name in files:
+                if file_has_proper_name(name):
+                        if not move_file(os.path.join(root, name), sub_path, name, root):
+                                left = True
+                elif name != "thumb.png":
+                        logger.warning(f"File '{name}' has invalid name, skipping")
+        if left:
+                pending_directories.add(root)
+        else:
+                pending_directories.discard(root)
+
+def file_is_stable(file):
+        # A file with the same size and mtime as in the previous cycle, and
+        # untouched for SHARE_STABLE_SECONDS, is no longer being written, so it
+        # does not need the open-file check again
+        try:
+                stat = os.stat(file)
+        except FileNotFoundError:
+                return False
+        state = (stat.st_size, stat.st_mtime_ns)
+        stable = file_states.get(file) == state and time.time() - stat.st_mtime >= TCMConstants.SHARE_STABLE_SECONDS
+        file_states[file] = state
+        return stable
+
+def get_sub_path(index, folder):
+        if TCMConstants.MULTI_CAR:
+                return f"{TCMConstants.CAR_LIST[index]}/{folder}"
+        return folder
+
 def move_file(file, folder, name, root):
         target_name = name
-        if name == "event.mp4":
+        folder_timestamp = None
+        if name == "event.mp4" or name == TCMConstants.EVENT_JSON:
                 # Attempt to get timestamp from folder name or fallback to file time
                 folder_timestamp = os.path.basename(root)
                 try:
@@ -69,27 +183,73 @@ def move_file(file, folder, name, root):
                 except:
                         ts = datetime.datetime.fromtimestamp(os.path.getmtime(file))
                         folder_timestamp = ts.strftime(TCMConstants.FILENAME_TIMESTAMP_FORMAT)
-                target_name = f"{folder_timestamp}-front.mp4"
+                if name == "event.mp4":
+                        target_name = f"{folder_timestamp}-front.mp4"
+                else:
+                        target_name = f"{folder_timestamp}-{TCMConstants.EVENT_JSON}"
 
         dest_raw = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{target_name}"
         dest_full = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}/{folder_timestamp}-full.mp4" if name == "event.mp4" else None
 
-        if TCMConstants.check_file_for_read(dest_raw):
-                logger.debug(f"Destination file already exists at: {dest_raw}")
-        else:
-                logger.info(f"Moving file {file} into {folder} as {target_name}")
-                if TCMConstants.check_file_for_read(file):
-                        try:
-                                shutil.move(file, dest_raw)
-                                logger.debug(f"Moved file {file} to {dest_raw}")
-                                # Copy to FULL folder as-is for event.mp4
-                                if dest_full:
-                                        shutil.copyfile(dest_raw, dest_full)
-                                        logger.debug(f"Copied single-camera clip to {dest_full}")
-                        except Exception as e:
-                                logger.error(f"Failed to move {file} to {dest_raw}: {e}")
+        # Returns True when nothing more can be done for this file, and False
+        # while it still has to be looked at again
+        if Metrics.timed_call("tcm_open_file_check_seconds", TCMConstants.check_file_for_read, dest_raw):
+                if not Ingest.is_busy(file) and Ingest.is_same_size(file, dest_raw):
+                        # Copied before, but LoadSSD stopped before the source was deleted
+                        logger.info(f"File {file} was already moved to {dest_raw}, removing it from the share")
+                        Ingest.remove_source(file)
                 else:
-                        logger.debug(f"File {file} still being written, skipping for now")
+                        logger.debug(f"Destination file already exists at: {dest_raw}")
+                return True
+        if Ingest.is_busy(file):
+                logger.debug(f"File {file} is already being moved")
+        elif file_is_stable(file) or Metrics.timed_call("tcm_open_file_check_seconds", TCMConstants.check_file_for_read, file):
+                logger.info(f"Moving file {file} into {folder} as {target_name}")
+                Ingest.submit(file, dest_raw, record_moved_file, folder, target_name, dest_full, folder_timestamp, root)
+        else:
+                logger.debug(f"File {file} still being written, skipping for now")
+        return False
+
+def record_moved_file(dest_raw, folder, target_name, dest_full, folder_timestamp, root):
+        FootageCatalog.record_raw_file(folder, target_name, os.path.getsize(dest_raw))
+        # Link (or copy) to FULL folder as-is for event.mp4
+        if dest_full:
+                method = TCMConstants.link_or_copy(dest_raw, dest_full)
+                logger.debug(f"Added single-camera clip to {dest_full} by {method}")
+                FootageCatalog.record_output(folder, folder_timestamp, TCMConstants.FULL_FOLDER, dest_full)
+        hand_off(root, folder, target_name)
+
+def hand_off(root, folder, target_name):
+        stamp, suffix = target_name.rsplit("-", 1)
+        with handoff_lock:
+                if suffix == TCMConstants.EVENT_JSON:
+                        events_moved.add(root)
+                        for waiting_stamp in sorted(waiting_for_event.pop(root, ())):
+                                post_stamp(folder, waiting_stamp)
+                elif suffix in FootageCatalog.CAMERA_COLUMNS:
+                        sizes = get_raw_sizes(folder, stamp)
+                        if sizes is None:
+                                return
+                        if root not in events_moved and os.path.isfile(os.path.join(root, TCMConstants.EVENT_JSON)):
+                                logger.debug(f"Holding {stamp} in {folder} until the event.json in {root} is moved")
+                                waiting_for_event.setdefault(root, set()).add(stamp)
+                        else:
+                                Spool.post(folder, stamp, sizes)
+
+def post_stamp(folder, stamp):
+        sizes = get_raw_sizes(folder, stamp)
+        if sizes is not None:
+                Spool.post(folder, stamp, sizes)
+
+def get_raw_sizes(folder, stamp):
+        # Sizes of all four camera files in Raw, or None while one is missing
+        sizes = {}
+        for camera in FootageCatalog.CAMERA_COLUMNS:
+                try:
+                        sizes[camera] = os.path.getsize(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{stamp}-{camera}")
+                except FileNotFoundError:
+                        return None
+        return sizes
 
 def file_has_proper_name(file):
         return (
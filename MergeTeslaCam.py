@@ -4,71 +4,192 @@
 # It looks for files at "RAW_PATH" and waits for all (front, left-repeater,
 # right-repeater, and back) are available for a single timestamp. Once all
 # four files are available, it merges them into one "full" file. It then
-# creates a sped-up view of the "full" file as the "fast" file.
+# creates a sped-up view of the "full" file as the "fast" file. Merges and
+# fast previews run in separate worker pools (MERGE_FULL_SLOTS and
+# MERGE_FAST_SLOTS) so several stamps are encoded at the same time. With
+# FFMPEG_SINGLE_PASS set, one ffmpeg run decodes the four cameras once and
+# writes both the full and the fast file, and the two-step path above is
+# only used as a fallback. With STITCH_EVENTS set, the full and fast files of
+# all the stamps of one event are then joined (without re-encoding) into one
+# event-level full and fast file. The
+# stamps to look at come from the footage catalog (FootageCatalog), which is
+# reconciled against the files on disk at startup and every
+# CATALOG_RECONCILE_INTERVAL seconds. With SPOOL_PATH set, stamps that LoadSSD
+# reports as moved (Spool) are merged first, and the catalog is only scanned
+# every FULL_SCAN_INTERVAL seconds to pick up anything else. With EVENT_DRIVEN
+# set, a new record in the spool (or a new file in any Raw folder, without a
+# spool) starts the next pass right away.
 
 import os
 import time
-import subprocess
+import shlex
+import tempfile
+import threading
 import datetime
 import TCMConstants
 import re
 import logging
-import json
 import multiprocessing
+import FootageCatalog
+import BadList
+import EventIndex
+import Inotify
+import EncoderCalibration
+import Mp4Check
+import Spool
+import FfmpegRunner
+import Metrics
+from WorkerPool import WorkerPool
+
+logger = TCMConstants.get_logger()
 
 # Dynamically calculate number of threads for ffmpeg
 total_cores = multiprocessing.cpu_count()
-ffmpeg_threads = max(1, (total_cores // 2) - 1)
-
-# ffmpeg commands and filters
-if TCMConstants.FFMPEG_ENCODER_PREFERENCE.lower() == 'intel':
-		ffmpeg_base = (
-				f'{TCMConstants.FFMPEG_PATH} -hide_banner -loglevel error '
-				f'-init_hw_device vaapi=va:/dev/dri/renderD128 -filter_hw_device va '
-				f'-timelimit {TCMConstants.FFMPEG_TIMELIMIT}'
-		)
-else:
-		ffmpeg_base = f'{TCMConstants.FFMPEG_PATH} -hide_banner -loglevel error -timelimit {TCMConstants.FFMPEG_TIMELIMIT}'
-if TCMConstants.FFMPEG_ENCODER_PREFERENCE.lower() == 'intel':
-		ffmpeg_encoder = '-c:v h264_vaapi'
-		ffmpeg_hwupload_full = '-vf "format=nv12,hwupload"'
-		ffmpeg_hwupload_fast = ',format=nv12,hwupload'
+
+# ffmpeg commands, as argument lists (ffmpeg is run without a shell), set by
+# set_encoder_commands. With 'auto', main() sets them again once the encoders
+# are calibrated; until then, or if calibrating fails, 'auto' encodes in software
+ffmpeg_base = []
+ffmpeg_encode_full = []
+ffmpeg_encode_fast = []
+ffmpeg_tail_full = ''
+ffmpeg_tail_combined = ''
+
+def set_encoder_commands(calibration=None):
+		global ffmpeg_base, ffmpeg_encode_full, ffmpeg_encode_fast, ffmpeg_tail_full, ffmpeg_tail_combined
+		ffmpeg_threads = max(1, ((total_cores // 2) - 1) // max(1, TCMConstants.MERGE_FAST_SLOTS))
+		ffmpeg_threads_full = 0
+		ffmpeg_preset_fast = []
+
+		# With a calibration, use the encoder, libx264 preset and thread counts
+		# measured to be fastest on this machine
+		encoder_preference = TCMConstants.FFMPEG_ENCODER_PREFERENCE.lower()
+		if calibration:
+				if calibration["full"]["encoder"] == 'h264_vaapi':
+						encoder_preference = 'intel'
+				if calibration["x264"]["preset"]:
+						ffmpeg_preset_fast = ['-preset', calibration["x264"]["preset"]]
+				ffmpeg_threads = max(1, calibration["x264"]["threads"] // max(1, TCMConstants.MERGE_FAST_SLOTS))
+				ffmpeg_threads_full = calibration["full"]["threads"]
+
+		ffmpeg_base = [TCMConstants.FFMPEG_PATH, '-hide_banner', '-loglevel', 'error']
+		if encoder_preference == 'intel':
+				ffmpeg_base += ['-init_hw_device', 'vaapi=va:/dev/dri/renderD128', '-filter_hw_device', 'va']
+		ffmpeg_base += ['-timelimit', str(TCMConstants.FFMPEG_TIMELIMIT)]
+		if encoder_preference == 'intel':
+				ffmpeg_encoder = ['-c:v', 'h264_vaapi']
+				ffmpeg_hwupload = ',format=nv12,hwupload'
+		elif calibration:
+				ffmpeg_encoder = ['-c:v', calibration["full"]["encoder"]]
+				if calibration["full"]["preset"]:
+						ffmpeg_encoder += ['-preset', calibration["full"]["preset"]]
+				ffmpeg_hwupload = ''
+		else:
+				ffmpeg_encoder = ['-c:v', 'libx264']
+				ffmpeg_hwupload = ''
+		ffmpeg_encode_full = ffmpeg_encoder + ['-movflags', '+faststart', '-threads', str(ffmpeg_threads_full)]
+
+		# MUST use Software encoding for FAST Previews
+		ffmpeg_encode_fast = (['-c:v', 'libx264'] + ffmpeg_preset_fast +
+			['-crf', '28', '-profile:v', 'main', '-tune', 'fastdecode',
+			'-movflags', '+faststart', '-threads', str(ffmpeg_threads)])
+
+		ffmpeg_tail_full = ffmpeg_hwupload
+		# Single pass: split the labeled mosaic, encode one copy as is and one sped up
+		ffmpeg_tail_combined = f',split=2[fullsrc][fastsrc];[fullsrc]null{ffmpeg_hwupload}[fullout];[fastsrc]{ffmpeg_filter_fast}[fastout]'
+
+fast_preview_mode = TCMConstants.FAST_PREVIEW_MODE.lower()
+ffmpeg_filter_fast = f'setpts=PTS/{TCMConstants.FAST_PREVIEW_SPEED}'
+if fast_preview_mode in ('fps', 'keyframes'):
+		ffmpeg_filter_fast += f',fps={TCMConstants.FAST_PREVIEW_FPS}'
+if fast_preview_mode == 'keyframes':
+		ffmpeg_input_fast = ['-skip_frame', 'nokey']
 else:
-		ffmpeg_encoder = '-c:v libx264'
-		ffmpeg_hwupload_full = ''
-		ffmpeg_hwupload_fast = ''
-
-# MUST use Software encoding for FAST Previews
-ffmpeg_end_fast = (
-	f'-vf "setpts=0.09*PTS" '
-	f'-c:v libx264 -crf 28 -profile:v main -tune fastdecode '
-	f'-movflags +faststart -threads {ffmpeg_threads}'
-)
-ffmpeg_end_full = '\':fontcolor=white:fontsize=24:box=1:boxcolor=black@0.5:boxborderw=5:x=(w-text_w)/2:y=h-text_h,format=nv12,hwupload" -c:v h264_vaapi -movflags +faststart -threads 0'
-ffmpeg_mid_full = f'-filter_complex "[1:v]scale=w={TCMConstants.FRONT_WIDTH}:h={TCMConstants.FRONT_HEIGHT}[top];[0:v]scale=w={TCMConstants.REST_WIDTH}:h={TCMConstants.REST_HEIGHT}[right];[3:v]scale=w={TCMConstants.REST_WIDTH}:h={TCMConstants.REST_HEIGHT}[back];[2:v]scale=w={TCMConstants.REST_WIDTH}:h={TCMConstants.REST_HEIGHT}[left];[left][back][right]hstack=inputs=3[bottom];[top][bottom]vstack=inputs=2[full];[full]drawtext=text=\''
-ffmpeg_mid2_full = '\':fontcolor=white:fontsize=24:box=1:boxcolor=black@0.5:boxborderw=5:x=(w-text_w)/2[labeled];[labeled]drawtext=text=\''
+		ffmpeg_input_fast = []
+ffmpeg_text_style = ':fontcolor=white:fontsize=24:box=1:boxcolor=black@0.5:boxborderw=5:x=(w-text_w)/2'
+ffmpeg_mosaic = f'[1:v]scale=w={TCMConstants.FRONT_WIDTH}:h={TCMConstants.FRONT_HEIGHT}[top];[0:v]scale=w={TCMConstants.REST_WIDTH}:h={TCMConstants.REST_HEIGHT}[right];[3:v]scale=w={TCMConstants.REST_WIDTH}:h={TCMConstants.REST_HEIGHT}[back];[2:v]scale=w={TCMConstants.REST_WIDTH}:h={TCMConstants.REST_HEIGHT}[left];[left][back][right]hstack=inputs=3[bottom];[top][bottom]vstack=inputs=2[full]'
+set_encoder_commands()
+# Event stitching joins finished outputs as they are, so no encoder options
+ffmpeg_concat = [TCMConstants.FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-y', '-f', 'concat', '-safe', '0']
 ffmpeg_error_regex = '(.*): Invalid data found when processing input'
 ffmpeg_error_pattern = re.compile(ffmpeg_error_regex)
-
-logger = TCMConstants.get_logger()
+# Job type of each ffmpeg command type, for Metrics
+FFMPEG_JOB_TYPES = {0 : "full", 1 : "fast", 2 : "single_pass"}
+
+# Stamp index: camera files of one stamp and the states a stamp can be in
+CAMERA_TEXTS = [TCMConstants.FRONT_TEXT, TCMConstants.LEFT_TEXT, TCMConstants.RIGHT_TEXT, TCMConstants.BACK_TEXT]
+BAD_LIST_FILENAMES = [TCMConstants.BAD_VIDEOS_FILENAME, TCMConstants.BAD_SIZES_FILENAME, TCMConstants.BAD_FASTPREVIEW_FILENAME]
+STAMP_INCOMPLETE = 'incomplete'
+STAMP_READY = 'ready'
+STAMP_MERGED = 'merged'
+STAMP_PREVIEWED = 'previewed'
+STAMP_BAD = 'bad'
+
+full_pool = None
+fast_pool = None
+stitch_pool = None
+# (folder, stamp) pairs whose events may need a stitch, stamp None for every
+# event in the folder
+stitch_marks = set()
+stitch_marks_lock = threading.Lock()
+# When each stamp missing camera files was first seen holding up a stitch
+incomplete_since = {}
+# Pool counts last logged by log_pool_status
+last_pool_status = None
+
+# Stamps with all four camera files that could not be merged or previewed
+# yet (a file still open, sizes too far apart, a full file not readable),
+# looked at again after SLEEP_DURATION instead of at the next full scan
+retry_stamps = set()
+retry_stamps_lock = threading.Lock()
 
 def main():
 		if not have_required_permissions():
 				logger.error("Missing some required permissions, exiting")
 				TCMConstants.exit_gracefully(TCMConstants.SPECIAL_EXIT_CODE, None)
 
+		if TCMConstants.FFMPEG_ENCODER_PREFERENCE.lower() == 'auto':
+				calibrate_encoders()
+
+		global full_pool, fast_pool, stitch_pool
+		full_pool = WorkerPool("Merge", TCMConstants.MERGE_FULL_SLOTS)
+		fast_pool = WorkerPool("Fast preview", TCMConstants.MERGE_FAST_SLOTS)
+		stitch_pool = WorkerPool("Stitch", 1)
+
+		watcher = Inotify.Watcher([TCMConstants.SPOOL_PATH] if TCMConstants.SPOOL_PATH else get_raw_paths())
+		last_reconcile = 0
+		last_scan = 0
 		while True:
 				logger.debug("Starting new iteration")
-				if TCMConstants.MULTI_CAR:
-						for car in TCMConstants.CAR_LIST:
-								loop_car(f"{car}/")
-				else:
-						loop_car("")
-
-				time.sleep(TCMConstants.SLEEP_DURATION)
+				Metrics.timed_call("tcm_open_files_scan_seconds", TCMConstants.refresh_open_files)
+				if time.time() - last_reconcile >= TCMConstants.CATALOG_RECONCILE_INTERVAL:
+						reconcile_catalog()
+						last_reconcile = time.time()
+				take_spool()
+				retry_waiting_stamps()
+				if not TCMConstants.SPOOL_PATH or time.time() - last_scan >= TCMConstants.FULL_SCAN_INTERVAL:
+						if TCMConstants.MULTI_CAR:
+								for car in TCMConstants.CAR_LIST:
+										loop_car(f"{car}/")
+						else:
+								loop_car("")
+						last_scan = time.time()
+				stitch_marked_events()
+				log_pool_status()
+
+				watcher.wait(get_wait_time(last_scan))
 
 ### Startup functions ###
 
+def calibrate_encoders():
+		# A failed calibration leaves the software encoder set up at import
+		try:
+				calibration = EncoderCalibration.get_calibration()
+		except Exception as e:
+				logger.error(f"Encoder calibration failed, encoding with libx264: {e}")
+				return
+		set_encoder_commands(calibration)
+
 def have_required_permissions():
 		have_perms = True
 		if TCMConstants.MULTI_CAR:
@@ -76,6 +197,8 @@ def have_required_permissions():
 						have_perms = have_perms and check_permissions_for_car(f"{car}/")
 		else:
 				have_perms = have_perms and check_permissions_for_car("")
+		if TCMConstants.SPOOL_PATH:
+				have_perms = have_perms and TCMConstants.check_permissions(TCMConstants.SPOOL_PATH, True)
 		return have_perms
 
 def check_permissions_for_car(car_path):
@@ -86,94 +209,375 @@ def check_permissions_for_car(car_path):
 				have_perms = have_perms and TCMConstants.check_permissions(f"{TCMConstants.FOOTAGE_PATH}{car_path}{folder}/{TCMConstants.FAST_FOLDER}", True)
 		return have_perms
 
+def get_raw_paths():
+		if TCMConstants.MULTI_CAR:
+				return [f"{TCMConstants.FOOTAGE_PATH}{car}/{folder}/{TCMConstants.RAW_FOLDER}" for car in TCMConstants.CAR_LIST for folder in TCMConstants.FOOTAGE_FOLDERS]
+		return [f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}" for folder in TCMConstants.FOOTAGE_FOLDERS]
+
+def reconcile_catalog():
+		if TCMConstants.MULTI_CAR:
+				for car in TCMConstants.CAR_LIST:
+						for folder in TCMConstants.FOOTAGE_FOLDERS:
+								FootageCatalog.reconcile(f"{car}/{folder}")
+								mark_for_stitching(f"{car}/{folder}")
+		else:
+				for folder in TCMConstants.FOOTAGE_FOLDERS:
+						FootageCatalog.reconcile(folder)
+						mark_for_stitching(folder)
+
 ### Loop functions ###
 
 def loop_car(car_path):
-		for folder in TCMConstants.FOOTAGE_FOLDERS:
-				raw_files = os.listdir(f"{TCMConstants.FOOTAGE_PATH}{car_path}{folder}/{TCMConstants.RAW_FOLDER}")
-				for file in raw_files:
-						logger.debug(f"Starting with file {file}")
-						try:
-								stamp, camera = file.rsplit("-", 1)
-						except ValueError:
-								if TCMConstants.EVENT_JSON not in file and file != TCMConstants.BAD_VIDEOS_FILENAME and file != TCMConstants.BAD_SIZES_FILENAME and file != TCMConstants.BAD_FASTPREVIEW_FILENAME:
-										logger.warning(f"Unrecognized filename: {file}")
-								continue
-						process_stamp(stamp, f"{car_path}{folder}")
-
-def process_stamp(stamp, folder):
+		# Submit the most urgent work first so an idle worker starts on it
+		for folder in sorted(TCMConstants.FOOTAGE_FOLDERS, key=get_folder_rank):
+				index = build_stamp_index(f"{car_path}{folder}")
+				for stamp in sorted(index["stamps"], reverse=True):
+						process_stamp(stamp, f"{car_path}{folder}", index["stamps"][stamp], index)
+
+def take_spool():
+		# LoadSSD has moved and verified these files, so they are not checked
+		# for open writers again
+		records = Spool.take()
+		records.sort(key=lambda record: get_priority(record["folder"], record["stamp"]))
+		for record in records:
+				folder, stamp = record["folder"], record["stamp"]
+				row = FootageCatalog.get_stamp(folder, stamp)
+				if row is None:
+						logger.warning(f"Spool record for {stamp} in {folder} is not in the catalog, leaving it to the scan")
+						continue
+				entry = get_stamp_entry(row)
+				entry["handed_off"] = True
+				process_stamp(stamp, folder, entry, get_bad_lists(folder))
+
+def retry_waiting_stamps():
+		with retry_stamps_lock:
+				waiting = sorted(retry_stamps)
+				retry_stamps.clear()
+		for folder, stamp in waiting:
+				row = FootageCatalog.get_stamp(folder, stamp)
+				if row is not None:
+						process_stamp(stamp, folder, get_stamp_entry(row), get_bad_lists(folder))
+
+def mark_for_retry(folder, stamp):
+		with retry_stamps_lock:
+				retry_stamps.add((folder, stamp))
+
+def get_bad_lists(folder):
+		return {"bad_videos": get_bad_list(folder, TCMConstants.BAD_VIDEOS_FILENAME),
+				"bad_sizes": get_bad_list(folder, TCMConstants.BAD_SIZES_FILENAME),
+				"bad_fastpreview": get_bad_list(folder, TCMConstants.BAD_FASTPREVIEW_FILENAME)}
+
+def get_wait_time(last_scan):
+		if TCMConstants.SPOOL_PATH:
+				remaining = max(1, TCMConstants.FULL_SCAN_INTERVAL - (time.time() - last_scan))
+		else:
+				remaining = TCMConstants.FULL_SCAN_INTERVAL
+		# Come back sooner while stamps wait to be tried again, or stitches wait
+		# for their merges to finish
+		if retry_stamps or stitch_marks or full_pool.in_flight() or fast_pool.in_flight():
+				return min(remaining, TCMConstants.SLEEP_DURATION)
+		return remaining
+
+def build_stamp_index(folder):
+		# The catalog groups the four camera files, the event.json and the
+		# outputs of every stamp under a single key, so nothing is rescanned
+		# here. Stamps that are already previewed or bad are left out.
+		index = {"stamps": {}}
+		for stamp, row in FootageCatalog.get_stamps(folder, (STAMP_PREVIEWED, STAMP_BAD)).items():
+				index["stamps"][stamp] = get_stamp_entry(row)
+		index.update(get_bad_lists(folder))
+		return index
+
+def get_stamp_entry(row):
+		return {
+				"cameras": FootageCatalog.get_camera_sizes(row),
+				"event": bool(row["has_event"]),
+				"full": row["full_path"] is not None,
+				"fast": row["fast_path"] is not None,
+				"state": row["state"]}
+
+def get_bad_list(folder, filename):
+		return BadList.get_bad_list(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{filename}")
+
+def get_stamp_state(stamp, folder, entry, index):
+		if stamp_is_bad(stamp, folder, index):
+				return STAMP_BAD
+		if entry["full"] and entry["fast"]:
+				return STAMP_PREVIEWED
+		if len(entry["cameras"]) < len(CAMERA_TEXTS):
+				return STAMP_INCOMPLETE
+		if entry["full"]:
+				return STAMP_MERGED
+		if stamp_is_all_ready(stamp, folder, entry):
+				return STAMP_READY
+		# The checks may just have put the stamp on a bad list
+		if stamp_is_bad(stamp, folder, index):
+				return STAMP_BAD
+		return STAMP_INCOMPLETE
+
+def stamp_is_bad(stamp, folder, index):
+		if f"{stamp}-{TCMConstants.FULL_TEXT}" in index["bad_fastpreview"]:
+				logger.debug(f"Skipping fast preview for bad file {stamp} in {folder}")
+				return True
+		if stamp in index["bad_sizes"]:
+				logger.debug(f"Skipping {stamp} in {folder} due to camera files of very different sizes")
+				return True
+		for camera in CAMERA_TEXTS:
+				if f"{stamp}-{camera}" in index["bad_videos"]:
+						logger.debug(f"Skipping {stamp} in {folder} due to bad data in {stamp}-{camera}")
+						return True
+		return False
+
+def process_stamp(stamp, folder, entry, index):
 	logger.debug(f"Processing stamp {stamp} in {folder}")
-	if file_is_bad_fastpreview(stamp, folder):
-		logger.debug(f"Skipping fast preview for bad file {stamp} in {folder}")
+	key = f"{folder}/{stamp}"
+	if full_pool.has(key) or fast_pool.has(key):
+		logger.debug(f"Stamp {stamp} in {folder} already queued or in flight")
 		return
 
-	if stamp_is_all_ready(stamp, folder):
-		logger.debug(f"Stamp {stamp} in {folder} is ready to go")
-		# Confirm all input files exist before calling ffmpeg
-		front_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{stamp}-{TCMConstants.FRONT_TEXT}"
-		left_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{stamp}-{TCMConstants.LEFT_TEXT}"
-		right_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{stamp}-{TCMConstants.RIGHT_TEXT}"
-		back_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{stamp}-{TCMConstants.BACK_TEXT}"
-		for f in [right_file, front_file, left_file, back_file]:
-			if not os.path.exists(f):
-				logger.error(f"Missing expected input file: {f}")
-			else:
-				logger.debug(f"Found input file: {f} ({os.path.getsize(f)} bytes)")
-
-		if TCMConstants.check_file_for_write(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}/{stamp}-{TCMConstants.FULL_TEXT}"):
-			run_ffmpeg_command("Merge", folder, stamp, 0)
+	state = get_stamp_state(stamp, folder, entry, index)
+	logger.debug(f"Stamp {stamp} in {folder} is {state}")
+	if state != entry["state"] and state != STAMP_READY:
+		FootageCatalog.set_state(folder, stamp, state)
+	if state == STAMP_INCOMPLETE and len(entry["cameras"]) == len(CAMERA_TEXTS):
+		mark_for_retry(folder, stamp)
+	if state == STAMP_READY:
+		full_pool.submit(key, get_priority(folder, stamp), merge_job, folder, stamp)
+	elif state == STAMP_MERGED:
+		fast_pool.submit(key, get_priority(folder, stamp), fast_preview_job, folder, stamp)
+
+def get_folder_rank(footage_folder):
+	return TCMConstants.FOLDER_PRIORITY.get(footage_folder, max(TCMConstants.FOLDER_PRIORITY.values(), default=0))
+
+def get_priority(folder, stamp):
+	# Jobs submitted in the same PRIORITY_AGING_SECONDS window compete on
+	# folder rank, then newest stamp. Each window a job has waited makes up
+	# for one step of folder rank.
+	rank = get_folder_rank(os.path.basename(folder))
+	try:
+		stamp_time = datetime.datetime.strptime(stamp, TCMConstants.FILENAME_TIMESTAMP_FORMAT).timestamp()
+	except ValueError:
+		stamp_time = 0
+	return (int(time.time() // max(1, TCMConstants.PRIORITY_AGING_SECONDS)) + rank, -stamp_time)
+
+def merge_job(folder, stamp):
+	full_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}/{stamp}-{TCMConstants.FULL_TEXT}"
+	fast_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FAST_FOLDER}/{stamp}-{TCMConstants.FAST_TEXT}"
+	if TCMConstants.FFMPEG_SINGLE_PASS and TCMConstants.check_file_for_write(fast_file):
+		if run_ffmpeg_command("Merge and fast preview", folder, stamp, 2):
+			FootageCatalog.record_output(folder, stamp, TCMConstants.FULL_FOLDER, full_file)
+			FootageCatalog.record_output(folder, stamp, TCMConstants.FAST_FOLDER, fast_file)
+			FootageCatalog.set_state(folder, stamp, STAMP_PREVIEWED)
+			mark_for_stitching(folder, stamp)
+			return
+		if get_bad_list(folder, TCMConstants.BAD_VIDEOS_FILENAME).has_any(f"{stamp}-{camera}" for camera in CAMERA_TEXTS):
+			remove_partial_outputs(full_file, fast_file)
+			return
+		logger.warning(f"Single pass failed for {stamp} in {folder}, falling back to separate merge and fast preview")
+		remove_partial_outputs(full_file, fast_file)
+	run_ffmpeg_command("Merge", folder, stamp, 0)
+	if not os.path.isfile(full_file):
+		return
+	FootageCatalog.record_output(folder, stamp, TCMConstants.FULL_FOLDER, full_file)
+	FootageCatalog.set_state(folder, stamp, STAMP_MERGED)
+	if TCMConstants.check_file_for_write(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FAST_FOLDER}/{stamp}-{TCMConstants.FAST_TEXT}"):
+		fast_pool.submit(f"{folder}/{stamp}", get_priority(folder, stamp), fast_preview_job, folder, stamp)
+
+def fast_preview_job(folder, stamp):
+	full_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}/{stamp}-{TCMConstants.FULL_TEXT}"
+	if Metrics.timed_call("tcm_open_file_check_seconds", TCMConstants.check_file_for_read, full_file):
+		if file_is_bad_fastpreview(stamp, folder):
+			logger.debug(f"Skipping fast preview because it's marked bad: {stamp}")
+			return
+
+		result = Mp4Check.scan_mp4(full_file)
+		logger.debug(f"MP4 structure of {full_file}: {result}")
+		if result["unreadable"]:
+			logger.warning(f"Unable to read {full_file}, postponing fast preview: {result['error']}")
+			mark_for_retry(folder, stamp)
+			return
+		if not Mp4Check.mp4_is_usable(result):
+			logger.warning(f"Skipping fast preview: {full_file} is missing moov atom or is not decodable.")
+			mark_bad_fastpreview(folder, f"{stamp}-{TCMConstants.FULL_TEXT}")
+			return
+
+		fast_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FAST_FOLDER}/{stamp}-{TCMConstants.FAST_TEXT}"
+		if TCMConstants.check_file_for_write(fast_file):
+			run_ffmpeg_command("Fast preview", folder, stamp, 1)
+			if os.path.isfile(fast_file):
+				FootageCatalog.record_output(folder, stamp, TCMConstants.FAST_FOLDER, fast_file)
+				FootageCatalog.set_state(folder, stamp, STAMP_PREVIEWED)
+				mark_for_stitching(folder, stamp)
 		else:
-			logger.debug(f"Full file exists for stamp {stamp}")
-
-		full_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}/{stamp}-{TCMConstants.FULL_TEXT}"
-		if TCMConstants.check_file_for_read(full_file):
-			if file_is_bad_fastpreview(stamp, folder):
-				logger.debug(f"Skipping fast preview because it's marked bad: {stamp}")
-				return
-
-			if not file_has_moov_atom(full_file):
-				logger.warning(f"Skipping fast preview: {full_file} is missing moov atom or is not decodable.")
-				mark_bad_fastpreview(folder, f"{stamp}-{TCMConstants.FULL_TEXT}")
-				return
+			logger.debug(f"Fast file already exists or isn't writable for stamp {stamp} at {folder}")
+	else:
+		logger.warning(f"Full file {full_file} not ready for read, postponing fast preview")
+		mark_for_retry(folder, stamp)
 
-			if TCMConstants.check_file_for_write(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FAST_FOLDER}/{stamp}-{TCMConstants.FAST_TEXT}"):
-				run_ffmpeg_command("Fast preview", folder, stamp, 1)
-			else:
-				logger.debug(f"Fast file already exists or isn't writable for stamp {stamp} at {folder}")
-		else:
-			logger.warning(f"Full file {TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}/{stamp}-{TCMConstants.FULL_TEXT} not ready for read, postponing fast preview")
+def remove_partial_outputs(*files):
+	for file in files:
+		try:
+			os.remove(file)
+		except FileNotFoundError:
+			pass
+		except OSError as e:
+			logger.warning(f"Failed to remove partial output {file}: {e}")
+
+def log_pool_status():
+		# Logged only when the counts change, the metrics are written every time
+		global last_pool_status
+		status = tuple((pool.queued(), pool.in_flight()) for pool in (full_pool, fast_pool, stitch_pool))
+		if status != last_pool_status:
+				logger.info(f"Merges: {status[0][0]} queued, {status[0][1]} in flight; fast previews: {status[1][0]} queued, {status[1][1]} in flight; stitches: {status[2][0]} queued, {status[2][1]} in flight")
+				last_pool_status = status
+		Metrics.clear("tcm_stamps_waiting")
+		for pool, stage in ((full_pool, "merge"), (fast_pool, "fast_preview")):
+				Metrics.set_gauge("tcm_pool_queued", pool.queued(), pool=pool.name)
+				Metrics.set_gauge("tcm_pool_in_flight", pool.in_flight(), pool=pool.name)
+				waiting = {}
+				for key in pool.get_queued_keys():
+						folder = key.rsplit("/", 1)[0]
+						waiting[folder] = waiting.get(folder, 0) + 1
+				for folder, count in waiting.items():
+						Metrics.set_gauge("tcm_stamps_waiting", count, folder=folder, stage=stage)
+		Metrics.set_gauge("tcm_pool_queued", stitch_pool.queued(), pool=stitch_pool.name)
+		Metrics.set_gauge("tcm_pool_in_flight", stitch_pool.in_flight(), pool=stitch_pool.name)
+		Metrics.write(force=True)
+
+### Event stitching functions ###
+
+def mark_for_stitching(folder, stamp=None):
+	if TCMConstants.STITCH_EVENTS:
+		with stitch_marks_lock:
+			stitch_marks.add((folder, stamp))
+
+def stitch_marked_events():
+	with stitch_marks_lock:
+		marks = list(stitch_marks)
+		stitch_marks.clear()
+	folders = {}
+	for folder, stamp in marks:
+		folders.setdefault(folder, set()).add(stamp)
+	for folder, stamps in sorted(folders.items()):
+		stitch_events(folder, stamps)
+
+def stitch_events(folder, stamps):
+	# Stitch the events the given stamps match (the same EVENT_DURATION
+	# matching as the watermark), or every event with None among the stamps
+	index = EventIndex.get_event_index(folder)
+	if None in stamps:
+		names = set(index.get_names())
 	else:
-		logger.debug(f"Stamp {stamp} not yet ready in {folder}")
-
-def stamp_is_all_ready(stamp, folder):
-		front_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{stamp}-{TCMConstants.FRONT_TEXT}"
-		left_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{stamp}-{TCMConstants.LEFT_TEXT}"
-		right_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{stamp}-{TCMConstants.RIGHT_TEXT}"
-		back_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{stamp}-{TCMConstants.BACK_TEXT}"
-		if file_is_bad(stamp, folder):
-				return False
-		if TCMConstants.check_file_for_read(front_file) and TCMConstants.check_file_for_read(left_file) and TCMConstants.check_file_for_read(right_file) and TCMConstants.check_file_for_read(back_file) and file_sizes_in_same_range(folder, stamp, front_file, left_file, right_file, back_file):
-				return True
-		else:
-				return False
+		names = set(event["name"] for event in map(index.find, stamps) if event is not None)
+	for name in sorted(names):
+		stitch_event(folder, index, name)
+
+def stitch_event(folder, index, name):
+	# Once none of the stamps of the event can change any more, queue a stitch
+	# if its stitched files are missing or leave out one of its previewed
+	# stamps. Only the stamps within EVENT_DURATION of the event are read.
+	event_stamp = name[:-len(EventIndex.EVENT_SUFFIX)]
+	event_time = datetime.datetime.strptime(event_stamp, TCMConstants.FILENAME_TIMESTAMP_FORMAT)
+	window = datetime.timedelta(seconds=TCMConstants.EVENT_DURATION)
+	rows = FootageCatalog.get_stamps_between(folder,
+		(event_time - window).strftime(TCMConstants.FILENAME_TIMESTAMP_FORMAT),
+		(event_time + window).strftime(TCMConstants.FILENAME_TIMESTAMP_FORMAT))
+	members = [(stamp, row) for stamp, row in rows.items() if (index.find(stamp) or {}).get("name") == name]
+	if not all(stamp_is_final(folder, stamp, row) for stamp, row in members):
+		logger.debug(f"Event {name} in {folder} still has merges pending, not stitching yet")
+		mark_for_stitching(folder, event_stamp)
+		return
+	for stamp, row in members:
+		incomplete_since.pop(f"{folder}/{stamp}", None)
+	# Only our own merges share encoder settings; the event.mp4 copied by
+	# LoadSSD has no fast file and is left out
+	stamps = sorted(stamp for stamp, row in members if row["state"] == STAMP_PREVIEWED and row["full_path"] and row["fast_path"])
+	if len(stamps) < 2:
+		return
+	outputs = []
+	for video_folder, text, member_text in ((TCMConstants.FULL_FOLDER, TCMConstants.EVENT_FULL_TEXT, TCMConstants.FULL_TEXT),
+			(TCMConstants.FAST_FOLDER, TCMConstants.EVENT_FAST_TEXT, TCMConstants.FAST_TEXT)):
+		inputs = [f"{TCMConstants.FOOTAGE_PATH}{folder}/{video_folder}/{stamp}-{member_text}" for stamp in stamps]
+		output = f"{TCMConstants.FOOTAGE_PATH}{folder}/{video_folder}/{event_stamp}-{text}"
+		if not stitched_file_is_current(folder, output, stamps):
+			outputs.append((output, inputs))
+	if outputs:
+		stitch_pool.submit(f"{folder}/{event_stamp}", get_priority(folder, event_stamp), stitch_job, folder, event_stamp, stamps, outputs)
+
+def stamp_is_final(folder, stamp, row):
+	# A stamp is final when nothing will be merged or previewed for it any
+	# more: previewed, bad, or an output with no four camera files to merge
+	# (the event.mp4 LoadSSD copies as is). One still missing camera files is
+	# given STITCH_INCOMPLETE_WAIT seconds for them to arrive.
+	key = f"{folder}/{stamp}"
+	if full_pool.has(key) or fast_pool.has(key):
+		return False
+	cameras = FootageCatalog.get_camera_sizes(row)
+	if row["state"] in (STAMP_PREVIEWED, STAMP_BAD) or not cameras:
+		return True
+	if row["full_path"] and len(cameras) < len(CAMERA_TEXTS):
+		return True
+	if row["state"] != STAMP_INCOMPLETE:
+		return False
+	first_seen = incomplete_since.setdefault(key, time.time())
+	return time.time() - first_seen > TCMConstants.STITCH_INCOMPLETE_WAIT
 
-def file_is_bad(stamp, folder):
-		if TCMConstants.check_file_for_read(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{TCMConstants.BAD_VIDEOS_FILENAME}"):
-				with open(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{TCMConstants.BAD_VIDEOS_FILENAME}", "r") as f:
-						bad_names = f.readlines()
-						check_list = [TCMConstants.FRONT_TEXT, TCMConstants.LEFT_TEXT, TCMConstants.RIGHT_TEXT, TCMConstants.BACK_TEXT]
-						for item in check_list:
-								if f"{stamp}-{item}\n" in bad_names:
-										logger.debug(f"Skipping {stamp} in {folder} due to bad data in {stamp}-{item}")
-										return True
-						return False
+def stitched_file_is_current(folder, output, stamps):
+	# Members that were removed since do not call for a new stitch, only
+	# ones that were not in it yet
+	if not os.path.isfile(output):
+		return False
+	return set(stamps) <= set(FootageCatalog.get_stitch_members(folder, output))
+
+def stitch_job(folder, event_stamp, stamps, outputs):
+	for output, inputs in outputs:
+		partial = f"{output}.partial"
+		with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as file_list:
+			for file in inputs:
+				escaped = file.replace("'", "'\\''")
+				file_list.write(f"file '{escaped}'\n")
+		command = ffmpeg_concat + ['-i', file_list.name, '-c', 'copy', '-movflags', '+faststart', '-f', 'mp4', partial]
+		logger.info(f"Stitching {len(inputs)} files of event {event_stamp} in {folder} into {output}")
+		logger.debug(f"Command: {shlex.join(command)}")
+		try:
+			returncode, stdout, stderr, stalled = FfmpegRunner.run(command, f"{folder}/{event_stamp}/{os.path.basename(output)}", f"Stitch of event {event_stamp} in {folder}", "stitch")
+		finally:
+			os.remove(file_list.name)
+		if returncode == 0 and not stderr:
+			os.replace(partial, output)
+			FootageCatalog.set_stitch_members(folder, output, stamps)
 		else:
+			logger.error(f"Error stitching {output}: returncode: {returncode}, stalled: {stalled}, stderr: {stderr}")
+			remove_partial_outputs(partial)
+
+def stamp_is_all_ready(stamp, folder, entry):
+		for camera in CAMERA_TEXTS:
+				file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{stamp}-{camera}"
+				if entry.get("handed_off"):
+						if not os.path.isfile(file):
+								return False
+				elif not Metrics.timed_call("tcm_open_file_check_seconds", TCMConstants.check_file_for_read, file):
+						return False
+				# Sizes in the catalog may predate the end of the copy
+				entry["cameras"][camera] = os.path.getsize(file)
+		if not file_sizes_in_same_range(folder, stamp, entry["cameras"]):
 				return False
+		# Truncated inputs would only fail after minutes of encoding
+		for camera in CAMERA_TEXTS:
+				file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{stamp}-{camera}"
+				result = Mp4Check.scan_mp4(file)
+				if result["unreadable"]:
+						# Could be the share or disk acting up, try again later
+						logger.warning(f"Unable to read input file {file}, will try again: {result['error']}")
+						return False
+				if not Mp4Check.mp4_is_usable(result):
+						logger.warning(f"Input file {file} is not a complete MP4: {result}")
+						add_to_bad_videos(folder, file)
+						return False
+		return True
 
 def mark_bad_fastpreview(folder, name):
-	path = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{TCMConstants.BAD_FASTPREVIEW_FILENAME}"
-	add_string_to_sorted_file(
-		path,
+	get_bad_list(folder, TCMConstants.BAD_FASTPREVIEW_FILENAME).add(
 		name,
 		f"{name}\n",
 		f"Logging {name} to {TCMConstants.BAD_FASTPREVIEW_FILENAME} to skip on subsequent runs.",
@@ -181,18 +585,13 @@ def mark_bad_fastpreview(folder, name):
 	)
 
 def file_is_bad_fastpreview(stamp, folder):
-	badfile = f"{stamp}-{TCMConstants.FULL_TEXT}"
-	path = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{TCMConstants.BAD_FASTPREVIEW_FILENAME}"
-	if not os.path.isfile(path):
-		return False
-	with open(path, "r") as f:
-		return badfile + "\n" in f.readlines()
-
-def file_sizes_in_same_range(folder, stamp, front_file, left_file, right_file, back_file):
-		front_size = os.path.getsize(front_file)
-		left_size = os.path.getsize(left_file)
-		right_size = os.path.getsize(right_file)
-		back_size = os.path.getsize(back_file)
+	return f"{stamp}-{TCMConstants.FULL_TEXT}" in get_bad_list(folder, TCMConstants.BAD_FASTPREVIEW_FILENAME)
+
+def file_sizes_in_same_range(folder, stamp, sizes):
+		front_size = sizes[TCMConstants.FRONT_TEXT]
+		left_size = sizes[TCMConstants.LEFT_TEXT]
+		right_size = sizes[TCMConstants.RIGHT_TEXT]
+		back_size = sizes[TCMConstants.BACK_TEXT]
 		if front_size == 0 or left_size == 0 or right_size == 0 or back_size == 0:
 				add_to_bad_sizes(
 						folder, stamp, TCMConstants.convert_file_size(front_size),
@@ -216,13 +615,11 @@ def file_sizes_in_same_range(folder, stamp, front_file, left_file, right_file, b
 def run_ffmpeg_command(log_text, folder, stamp, video_type):
 		logger.info(f"{log_text} started in {stamp}: {folder}...")
 		command = get_ffmpeg_command(folder, stamp, video_type)
-		logger.debug(f"Command: {command}")
-		completed = subprocess.run(command, shell=True,
-				stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
-				stderr=subprocess.PIPE)
-		if completed.stderr or completed.returncode != 0:
-				logger.error(f"Error running ffmpeg command: {command}, returncode: {completed.returncode}, stdout: {completed.stdout}, stderr: {completed.stderr}")
-				for line in completed.stderr.decode("UTF-8").splitlines():
+		logger.debug(f"Command: {shlex.join(command)}")
+		returncode, stdout, stderr, stalled = FfmpegRunner.run(command, f"{folder}/{stamp}/{video_type}", f"{log_text} of {stamp} in {folder}", FFMPEG_JOB_TYPES[video_type])
+		if stderr or returncode != 0:
+				logger.error(f"Error running ffmpeg command: {shlex.join(command)}, returncode: {returncode}, stalled: {stalled}, stderr: {stderr}")
+				for line in stderr.decode("UTF-8", "replace").splitlines():
 						match = ffmpeg_error_pattern.match(line)
 						if match:
 								file = match.group(1)
@@ -235,69 +632,57 @@ def run_ffmpeg_command(log_text, folder, stamp, video_type):
 								else:
 										add_to_bad_videos(folder, file)
 		else:
-				logger.debug(f"FFMPEG stdout: {completed.stdout}, stderr: {completed.stderr}")
+				logger.debug(f"FFMPEG stderr: {stderr}")
 		logger.info(f"{log_text} completed: {stamp}.")
+		return returncode == 0 and not stderr
 
 def get_ffmpeg_command(folder, stamp, video_type):
 		logger.debug(f"Get command: folder {folder}, stamp {stamp}, type {video_type}")
-		if video_type == 0:
-				command = "{0} -i {1}{2}/{3}/{4}-{5} -i {1}{2}/{3}/{4}-{6} -i {1}{2}/{3}/{4}-{7} -i {1}{2}/{3}/{4}-{8} {9}{10}{11}{12}{13} {1}{2}/{14}/{4}-{15}".format(
-						ffmpeg_base, TCMConstants.FOOTAGE_PATH, folder, TCMConstants.RAW_FOLDER, stamp, TCMConstants.RIGHT_TEXT,
-						TCMConstants.FRONT_TEXT, TCMConstants.LEFT_TEXT, TCMConstants.BACK_TEXT, ffmpeg_mid_full,
-						format_timestamp(stamp), ffmpeg_mid2_full, get_event_string(folder, stamp), ffmpeg_end_full, TCMConstants.FULL_FOLDER, TCMConstants.FULL_TEXT)
-		elif video_type == 1:
-				command = "{0} -i {1}{2}/{3}/{4}-{5} {6} {1}{2}/{7}/{4}-{8}".format(
-						ffmpeg_base, TCMConstants.FOOTAGE_PATH, folder, TCMConstants.FULL_FOLDER, stamp, TCMConstants.FULL_TEXT, ffmpeg_end_fast,
-						TCMConstants.FAST_FOLDER, TCMConstants.FAST_TEXT)
+		raw_path = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{stamp}"
+		full_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}/{stamp}-{TCMConstants.FULL_TEXT}"
+		fast_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FAST_FOLDER}/{stamp}-{TCMConstants.FAST_TEXT}"
+		if video_type == 1:
+				command = ffmpeg_base + ffmpeg_input_fast + ['-i', full_file, '-vf', ffmpeg_filter_fast] + ffmpeg_encode_fast + [fast_file]
+		elif video_type in (0, 2):
+				command = list(ffmpeg_base)
+				for camera in (TCMConstants.RIGHT_TEXT, TCMConstants.FRONT_TEXT, TCMConstants.LEFT_TEXT, TCMConstants.BACK_TEXT):
+						command += ['-i', f"{raw_path}-{camera}"]
+				mosaic = (f"{ffmpeg_mosaic};[full]drawtext=text='{format_timestamp(stamp)}'{ffmpeg_text_style}[labeled];"
+						f"[labeled]drawtext=text='{get_event_string(folder, stamp)}'{ffmpeg_text_style}:y=h-text_h")
+				if video_type == 0:
+						command += ['-filter_complex', f"{mosaic}{ffmpeg_tail_full}"] + ffmpeg_encode_full + [full_file]
+				else:
+						command += (['-filter_complex', f"{mosaic}{ffmpeg_tail_combined}", '-map', '[fullout]'] + ffmpeg_encode_full + [full_file]
+								+ ['-map', '[fastout]'] + ffmpeg_encode_fast + [fast_file])
 		else:
 				logger.error(f"Unrecognized video type {video_type} for {stamp} in {folder}")
+				command = []
 		logger.debug(command)
 		return command
 
 def get_event_string(folder, stamp):
 		logger.debug(f"Getting event string: folder {folder}, stamp {stamp}")
-		list = os.listdir(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/")
-		for file in list:
-				if TCMConstants.EVENT_JSON in file and file != "-event.json":
-						if event_matches_stamp(file, stamp):
-								with open(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{file}", "r") as jsonfile:
-										event = json.load(jsonfile)
-										jsonstamp = format_timestamp(event['timestamp'].replace('T', '_').replace(':', '-'), True)
-										try:
-												reason = TCMConstants.EVENT_REASON[event['reason']]
-										except:
-												reason = event['reason']
-										try:
-												camera = TCMConstants.EVENT_CAMERA[event['camera']]
-										except:
-												camera = 'camera ' + event['camera']
-										logger.debug(f"{reason} in {event['city']} at {jsonstamp} on camera {camera}")
-										return f"{reason} in {event['city']} at {jsonstamp} on {camera}"
-		return "No event information available"
-
-def event_matches_stamp(file, stamp):
+		event = EventIndex.get_event_index(folder).find(stamp)
+		if event is None:
+				return "No event information available"
 		try:
-				file_time = datetime.datetime.fromisoformat(file.rsplit('-',1)[0].split('_')[0] + 'T' + file.rsplit('-',1)[0].split('_')[1].replace('-',':'))
-				stamp_time = datetime.datetime.fromisoformat(stamp.split('_')[0] + 'T' + stamp.split('_')[1].replace('-',':'))
-				max_delta = datetime.timedelta(days=0, seconds=TCMConstants.EVENT_DURATION)
-				if (abs(file_time - stamp_time) <= max_delta):
-						return True
-				else:
-						return False
-		except:
-				return False
+				jsonstamp = format_timestamp(event['timestamp'].replace('T', '_').replace(':', '-'), True)
+		except (AttributeError, ValueError):
+				jsonstamp = str(event['timestamp']).replace(':', '\\:')
+		reason = TCMConstants.EVENT_REASON.get(event['reason'], event['reason'])
+		camera = TCMConstants.EVENT_CAMERA.get(event['camera'], f"camera {event['camera']}")
+		logger.debug(f"{reason} in {event['city']} at {jsonstamp} on camera {camera}")
+		return f"{reason} in {event['city']} at {jsonstamp} on {camera}"
 
 def add_to_bad_videos(folder, name):
 		simple_name = name.replace(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/", '')
-		add_string_to_sorted_file(
-				f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{TCMConstants.BAD_VIDEOS_FILENAME}",
+		get_bad_list(folder, TCMConstants.BAD_VIDEOS_FILENAME).add(
 				simple_name, f"{simple_name}\n",
 				f"Skipping over bad source file: {name}",
 				logging.DEBUG)
 
 def add_to_bad_sizes(folder, stamp, front, left, right, back):
-		add_string_to_sorted_file(
-				f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{TCMConstants.BAD_SIZES_FILENAME}",
+		get_bad_list(folder, TCMConstants.BAD_SIZES_FILENAME).add(
 				stamp,
 				f"{stamp}: Front {front}, Left {left}, Right {right}, Back: {back}\n",
 				f"Size issue at {stamp} in {folder}: Front {front}, Left {left}, Right {right}, Back: {back}",
@@ -305,21 +690,6 @@ def add_to_bad_sizes(folder, stamp, front, left, right, back):
 
 ### Other utility functions ###
 
-def add_string_to_sorted_file(name, key, string, log_message, log_level):
-		files = []
-		if os.path.isfile(name):
-				with open(name, "r") as file:
-						files = file.readlines()
-						for line in files:
-								if key in line:
-										return
-		files.append(string)
-		with open(name, "w+") as writer:
-				outlist = sorted(files)
-				logger.log(log_level, log_message)
-				for line in outlist:
-						writer.write(line)
-
 def format_timestamp(stamp, seconds=False):
 		timestamp = datetime.datetime.strptime(stamp, TCMConstants.FILENAME_TIMESTAMP_FORMAT)
 		logger.debug(f"Timestamp: {timestamp}")
@@ -328,16 +698,5 @@ def format_timestamp(stamp, seconds=False):
 		else:
 				return timestamp.strftime(TCMConstants.WATERMARK_TIMESTAMP_FORMAT)
 
-def file_has_moov_atom(path):
-		try:
-				result = subprocess.run(
-						[TCMConstants.FFPROBE_PATH, "-v", "error", "-select_streams", "v:0", "-show_entries",
-						"format=duration", "-of", "default=noprint_wrappers=1:nokey=1", path],
-						stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-				return result.returncode == 0 and result.stdout.strip()
-		except Exception as e:
-				logger.warning(f"ffprobe check failed for {path}: {e}")
-				return False
-
 if __name__ == '__main__':
 		main()
@@ -0,0 +1,124 @@
+# This module keeps counters and gauges for each service and writes them in
+# the Prometheus text format to METRICS_PATH, one file per service (e.g.
+# MergeTeslaCam.prom), at most every METRICS_WRITE_INTERVAL seconds. Point
+# the textfile collector of node_exporter at METRICS_PATH to scrape them.
+# Counters start from zero when a service restarts, which rate() handles.
+
+import os
+import time
+import threading
+import logging
+import TCMConstants
+
+# Type and help text of every metric the services report
+METRICS = {
+	"tcm_pool_queued" : ("gauge", "Jobs waiting in a MergeTeslaCam worker pool"),
+	"tcm_pool_in_flight" : ("gauge", "Jobs running in a MergeTeslaCam worker pool"),
+	"tcm_stamps_waiting" : ("gauge", "Stamps waiting for a merge or fast preview, per footage folder"),
+	"tcm_ffmpeg_jobs_total" : ("counter", "ffmpeg runs finished, per job type and result"),
+	"tcm_ffmpeg_wall_seconds" : ("summary", "Wall-clock seconds of ffmpeg runs, per job type"),
+	"tcm_ffmpeg_cpu_seconds_total" : ("counter", "CPU seconds used by ffmpeg, per job type"),
+	"tcm_ffmpeg_frames_total" : ("counter", "Frames encoded by ffmpeg, per job type"),
+	"tcm_ffmpeg_fps" : ("gauge", "Average frames per second of the last finished ffmpeg run, per job type"),
+	"tcm_open_file_check_seconds" : ("summary", "Seconds taken to check whether a file is still being written (with lsof when /proc can not be scanned)"),
+	"tcm_open_files_scan_seconds" : ("summary", "Seconds taken by a scan of the files open in /proc"),
+	"tcm_mp4_check_seconds" : ("summary", "Seconds taken to check the structure of an MP4 file"),
+	"tcm_ingest_bytes_total" : ("counter", "Bytes moved from the share into Raw, per method"),
+	"tcm_ingest_files_total" : ("counter", "Files moved from the share into Raw, per method"),
+	"tcm_upload_bytes_total" : ("counter", "Bytes uploaded by rclone"),
+	"tcm_upload_files_total" : ("counter", "Files uploaded by rclone, per result"),
+	"tcm_upload_deduplicated_bytes_total" : ("counter", "Bytes not uploaded because the same content was uploaded before"),
+	"tcm_removed_bytes_total" : ("counter", "Bytes freed by removing footage, per reason"),
+	"tcm_removed_files_total" : ("counter", "Footage files removed, per reason"),
+}
+
+values = {}
+lock = threading.Lock()
+last_write = 0
+write_failed = False
+
+def inc(name, amount=1, **labels):
+	with lock:
+		key = (name, tuple(sorted(labels.items())))
+		values[key] = values.get(key, 0) + amount
+	write()
+
+def set_gauge(name, value, **labels):
+	with lock:
+		values[(name, tuple(sorted(labels.items())))] = value
+	write()
+
+def clear(name):
+	# Drops every series of a gauge, before setting the ones that still exist
+	with lock:
+		for key in [key for key in values if key[0] == name]:
+			del values[key]
+
+def observe(name, seconds, **labels):
+	# Summaries are kept as their _count and _sum series
+	with lock:
+		key = tuple(sorted(labels.items()))
+		values[(f"{name}_count", key)] = values.get((f"{name}_count", key), 0) + 1
+		values[(f"{name}_sum", key)] = values.get((f"{name}_sum", key), 0) + seconds
+	write()
+
+def timed(name, **labels):
+	return Timer(name, labels)
+
+def timed_call(name, function, *args):
+	# Runs function(*args) and observes how long it took
+	with timed(name):
+		return function(*args)
+
+class Timer:
+
+	def __init__(self, name, labels):
+		self.name = name
+		self.labels = labels
+
+	def __enter__(self):
+		self.start = time.monotonic()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		observe(self.name, time.monotonic() - self.start, **self.labels)
+		return False
+
+def write(force=False):
+	global last_write, write_failed
+	if not TCMConstants.METRICS_PATH:
+		return
+	path = f"{TCMConstants.METRICS_PATH}{TCMConstants.get_basename()}.prom"
+	with lock:
+		if not force and time.time() - last_write < TCMConstants.METRICS_WRITE_INTERVAL:
+			return
+		last_write = time.time()
+		text = render()
+		try:
+			os.makedirs(TCMConstants.METRICS_PATH, exist_ok=True)
+			with open(f"{path}.tmp", "w") as writer:
+				writer.write(text)
+			os.replace(f"{path}.tmp", path)
+			write_failed = False
+		except OSError as e:
+			# Only the first failure in a row is worth a warning
+			logger = logging.getLogger(TCMConstants.get_basename())
+			logger.log(logging.DEBUG if write_failed else logging.WARNING, f"Unable to write metrics to {path}: {e}")
+			write_failed = True
+
+def render():
+	lines = []
+	for name, (metric_type, help_text) in METRICS.items():
+		series = sorted((key, value) for key, value in values.items() if key[0] == name or
+			(metric_type == "summary" and key[0] in (f"{name}_count", f"{name}_sum")))
+		if not series:
+			continue
+		lines.append(f"# HELP {name} {help_text}")
+		lines.append(f"# TYPE {name} {metric_type}")
+		for (series_name, labels), value in series:
+			label_text = ",".join(f'{label}="{escape(str(label_value))}"' for label, label_value in labels)
+			lines.append(f"{series_name}{{{label_text}}} {value}" if label_text else f"{series_name} {value}")
+	return "\n".join(lines) + "\n"
+
+def escape(value):
+	return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
@@ -0,0 +1,107 @@
+# This module checks the structure of an MP4 file without starting ffprobe.
+# It walks the top-level boxes with seeks, flags a box that runs past the end
+# of the file as truncated, and reads the movie duration from mvhd and the
+# number of tracks (trak boxes with a tkhd) from moov. A file is usable when
+# it has a moov and an mdat, nothing is truncated, and it has at least one
+# track and a non-zero duration. A file that could not be read at all is
+# flagged as unreadable instead, as that may well pass.
+
+import os
+import struct
+import Metrics
+
+HEADER = struct.Struct(">I4s")
+LARGE_SIZE = struct.Struct(">Q")
+MVHD_V0 = struct.Struct(">II")	# timescale and duration at offset 12
+MVHD_V1 = struct.Struct(">IQ")	# timescale and duration at offset 20
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+
+def scan_mp4(path):
+	with Metrics.timed("tcm_mp4_check_seconds"):
+		return read_mp4(path)
+
+def read_mp4(path):
+	result = {"has_moov" : False, "has_mdat" : False, "fragmented" : False,
+		"truncated" : False, "duration" : 0, "tracks" : 0, "unreadable" : False, "error" : None}
+	try:
+		file_size = os.path.getsize(path)
+		with open(path, "rb") as file:
+			offset = 0
+			while offset < file_size:
+				box_type, box_size, header_size = read_box_header(file, offset, file_size)
+				if box_type is None or box_size < header_size or offset + box_size > file_size:
+					result["truncated"] = True
+					break
+				if box_type == b"moov":
+					result["has_moov"] = True
+					if box_size - header_size > MAX_MOOV_SIZE:
+						result["error"] = "moov box too large"
+						break
+					file.seek(offset + header_size)
+					parse_moov(file.read(box_size - header_size), result)
+				elif box_type == b"mdat":
+					result["has_mdat"] = True
+				elif box_type == b"moof":
+					result["fragmented"] = True
+				offset += box_size
+	except OSError as e:
+		result["unreadable"] = True
+		result["error"] = str(e)
+	except (struct.error, IndexError, ValueError) as e:
+		result["error"] = f"malformed box: {e}"
+	return result
+
+def mp4_is_usable(result):
+	return (result["error"] is None and not result["truncated"] and result["has_moov"]
+		and result["has_mdat"] and result["tracks"] > 0
+		and (result["duration"] > 0 or result["fragmented"]))
+
+def read_box_header(file, offset, file_size):
+	if offset + HEADER.size > file_size:
+		return None, 0, 0
+	file.seek(offset)
+	box_size, box_type = HEADER.unpack(file.read(HEADER.size))
+	header_size = HEADER.size
+	if box_size == 1:
+		if offset + HEADER.size + LARGE_SIZE.size > file_size:
+			return None, 0, 0
+		box_size = LARGE_SIZE.unpack(file.read(LARGE_SIZE.size))[0]
+		header_size += LARGE_SIZE.size
+	elif box_size == 0:
+		box_size = file_size - offset
+	return box_type, box_size, header_size
+
+def parse_moov(data, result):
+	offset = 0
+	while offset + HEADER.size <= len(data):
+		box_size, box_type = HEADER.unpack_from(data, offset)
+		header_size = HEADER.size
+		if box_size == 1:
+			box_size = LARGE_SIZE.unpack_from(data, offset + HEADER.size)[0]
+			header_size += LARGE_SIZE.size
+		elif box_size == 0:
+			box_size = len(data) - offset
+		if box_size < header_size or offset + box_size > len(data):
+			result["truncated"] = True
+			return
+		body = data[offset + header_size:offset + box_size]
+		if box_type == b"mvhd":
+			result["duration"] = parse_mvhd(body)
+		elif box_type == b"trak" and b"tkhd" in body[:16]:
+			result["tracks"] += 1
+		offset += box_size
+
+def parse_mvhd(body):
+	# A short mvhd has no duration to read, which makes the file unusable
+	if not body:
+		return 0
+	if body[0] == 1:
+		fields, offset = MVHD_V1, 20
+	else:
+		fields, offset = MVHD_V0, 12
+	if len(body) < offset + fields.size:
+		return 0
+	timescale, duration = fields.unpack_from(body, offset)
+	if timescale == 0:
+		return 0
+	return duration / timescale
@@ -6,19 +6,30 @@
 # that have a name with a timestamp more than "DAYS_TO_KEEP" days old
 # Files and directories who names don't match this format are left alone
 # DAYS_TO_KEEP can be overridden on a case-by-case with parameters seen
-# in TCMConstants.py.
+# in TCMConstants.py. Removed files are also dropped from the footage
+# catalog (FootageCatalog). When the footage disk is fuller than
+# DISK_HIGH_WATERMARK, older files are removed early in EVICTION_ORDER until
+# it is below DISK_LOW_WATERMARK.
+# The expiry time of each video file is worked out once and kept by
+# RetentionPlanner, so each loop only handles the files that are due. Run
+# with --dry-run to list what will be removed and when, without removing it.
 
 import os
+import sys
 import time
 import shutil
 import TCMConstants
 import Stats
+import FootageCatalog
+import RetentionPlanner
+import Metrics
 import datetime
 import re
+import heapq
 
 VIDEO_PATHS = []
 
-ALL_VIDEO_REGEX = f"{TCMConstants.FILENAME_REGEX[:-5]}|fast|full).mp4"
+ALL_VIDEO_REGEX = f"{TCMConstants.FILENAME_REGEX[:-5]}|fast|full|eventfast|eventfull).mp4"
 ALL_VIDEO_PATTERN = re.compile(ALL_VIDEO_REGEX)
 EVENTFILE_REGEX  = '(\d{4}(-\d\d){2}_(\d\d-){3})event.json'
 EVENTFILE_PATTERN = re.compile(EVENTFILE_REGEX)
@@ -26,15 +37,18 @@ EVENTFILE_PATTERN = re.compile(EVENTFILE_REGEX)
 logger = TCMConstants.get_logger()
 
 def main():
+	if len(sys.argv) > 1 and sys.argv[1] == "--dry-run":
+		setup_all_video_paths()
+		report_plan()
+		return
+
 	if not have_required_permissions():
 		logger.error("Missing some required permissions, exiting")
 		TCMConstants.exit_gracefully(TCMConstants.SPECIAL_EXIT_CODE, None)
 
-	if TCMConstants.MULTI_CAR:
-		for car in TCMConstants.CAR_LIST:
-			setup_video_paths(f"{car}/")
-	else:
-		setup_video_paths("")
+	setup_all_video_paths()
+	planner = RetentionPlanner.RetentionPlanner(TCMConstants.RETENTION_PLAN_PATH, get_expiry)
+	last_stats_minute = None
 	while True:
 		logger.debug("Entered main loop")
 		for share in TCMConstants.SHARE_PATHS:
@@ -52,24 +66,44 @@ def main():
 						remove_empty_old_directory(f"{share}{folder}/", directory)
 
 		for path in VIDEO_PATHS:
-			logger.debug(f"Looking in VIDEO_PATH: {path}")
-		if not os.path.exists(path):
-			logger.warning(f"VIDEO_PATH missing: {path}")
-		for file in os.listdir(path):
-			logger.debug(f"Found file: {file}")
-			stamp = extract_stamp(file)
-			logger.debug(f"Extracted stamp: {stamp}")
-			if is_old_enough(stamp, path):
-				logger.debug(f"File is old enough: {file}")
+			if not os.path.exists(path):
+				logger.warning(f"VIDEO_PATH missing: {path}")
+		planner.refresh(VIDEO_PATHS)
+		for path, file in planner.pop_due(time.time()):
 			remove_old_file(path, file)
+			if os.path.exists(f"{path}/{file}"):
+				# Not removed, try again after SLEEP_DURATION
+				planner.add(path, file, time.time() + TCMConstants.SLEEP_DURATION)
+		planner.save()
+
+		evict_for_space()
 
-		if datetime.datetime.now().minute in TCMConstants.STATS_FREQUENCY:
+		# The loop can run more than once in a minute, stats only once
+		minute = datetime.datetime.now().replace(second=0, microsecond=0)
+		if minute.minute in TCMConstants.STATS_FREQUENCY and minute != last_stats_minute:
 			Stats.generate_stats_image()
+			last_stats_minute = minute
 
-		time.sleep(TCMConstants.SLEEP_DURATION)
+		Metrics.write(force=True)
+		time.sleep(get_sleep_time(planner))
+
+def get_sleep_time(planner):
+	# Wake up in time for the next file that is due
+	wait = TCMConstants.SLEEP_DURATION
+	next_due = planner.next_due()
+	if next_due is not None:
+		wait = max(1, min(wait, next_due - time.time()))
+	return wait
 
 ### Startup functions ###
 
+def setup_all_video_paths():
+	if TCMConstants.MULTI_CAR:
+		for car in TCMConstants.CAR_LIST:
+			setup_video_paths(f"{car}/")
+	else:
+		setup_video_paths("")
+
 def setup_video_paths(car_path):
 	for folder in TCMConstants.FOOTAGE_FOLDERS:
 		VIDEO_PATHS.append(f"{TCMConstants.FOOTAGE_PATH}{car_path}{folder}/{TCMConstants.RAW_FOLDER}")
@@ -101,16 +135,103 @@ def remove_old_file(path, file):
 	if is_old_enough(extract_stamp(file), path):
 		logger.info(f"Removing old file: {path}/{file}")
 		try:
+			size = get_freed_size(f"{path}/{file}")
 			os.remove(f"{path}/{file}")
-			pass
 		except:
 			logger.error(f"Error removing file: {path}/{file}")
+			return
+		Metrics.inc("tcm_removed_bytes_total", size, reason="age")
+		Metrics.inc("tcm_removed_files_total", reason="age")
+		footage_folder, video_folder = split_video_path(path)
+		FootageCatalog.forget_file(footage_folder, video_folder, file)
 	else:
 		logger.debug(f"File {path}/{file} is not ready for deletion, skipping")
 
+def evict_for_space():
+	if TCMConstants.DISK_HIGH_WATERMARK is None:
+		return
+	used = TCMConstants.get_used_percentage(TCMConstants.FOOTAGE_PATH)
+	if used < TCMConstants.DISK_HIGH_WATERMARK:
+		return
+	logger.warning(f"Footage disk is {used:.1f}% full, removing files until it is below {TCMConstants.DISK_LOW_WATERMARK}%")
+	# heapify is linear in the number of files, and only the files actually
+	# removed are popped from it
+	candidates = get_eviction_candidates()
+	heapq.heapify(candidates)
+	removed = freed = 0
+	while candidates and used >= TCMConstants.DISK_LOW_WATERMARK:
+		for i in range(min(TCMConstants.EVICTION_BATCH, len(candidates))):
+			rank, stamp, path, file, size = heapq.heappop(candidates)
+			try:
+				size = get_freed_size(f"{path}/{file}")
+				os.remove(f"{path}/{file}")
+			except FileNotFoundError:
+				continue
+			except OSError as e:
+				logger.error(f"Error evicting file: {path}/{file}: {e}")
+				continue
+			footage_folder, video_folder = split_video_path(path)
+			FootageCatalog.forget_file(footage_folder, video_folder, file)
+			removed += 1
+			freed += size
+			Metrics.inc("tcm_removed_bytes_total", size, reason="space")
+			Metrics.inc("tcm_removed_files_total", reason="space")
+		used = TCMConstants.get_used_percentage(TCMConstants.FOOTAGE_PATH)
+	logger.warning(f"Evicted {removed} files ({TCMConstants.convert_file_size(freed)}), footage disk is now {used:.1f}% full")
+
+def get_freed_size(path):
+	# Removing one name of a file with other hard links (an event.mp4 linked
+	# into Full by LoadSSD) frees nothing
+	stat = os.stat(path, follow_symlinks=False)
+	return stat.st_size if stat.st_nlink == 1 else 0
+
+def get_eviction_candidates():
+	candidates = []
+	car_paths = [f"{car}/" for car in TCMConstants.CAR_LIST] if TCMConstants.MULTI_CAR else [""]
+	for rank, (footage_folder, video_folder) in enumerate(TCMConstants.EVICTION_ORDER):
+		if footage_folder == 'SavedClips':
+			logger.warning("SavedClips is in EVICTION_ORDER but is never evicted, skipping it")
+			continue
+		for car_path in car_paths:
+			path = f"{TCMConstants.FOOTAGE_PATH}{car_path}{footage_folder}/{video_folder}"
+			try:
+				with os.scandir(path) as entries:
+					for item in entries:
+						match = ALL_VIDEO_PATTERN.fullmatch(item.name)
+						if match and item.is_file(follow_symlinks=False):
+							candidates.append((rank, match.group(1)[:-1], path, item.name, item.stat(follow_symlinks=False).st_size))
+			except FileNotFoundError:
+				continue
+	return candidates
+
+def get_expiry(path, file):
+	# Epoch time from which is_old_enough is true for the file, or None if it
+	# has no stamp and is never removed
+	stamp_in_name = extract_stamp(file)
+	if stamp_in_name is None:
+		return None
+	try:
+		stamp = datetime.datetime.strptime(stamp_in_name, TCMConstants.FILENAME_TIMESTAMP_FORMAT)
+	except ValueError:
+		logger.debug(f"Unrecognized name: {stamp_in_name}, skipping")
+		return None
+	return (stamp + datetime.timedelta(days=get_days_to_keep(path) + 1)).timestamp()
+
+def report_plan():
+	# Lists the planned removals without removing anything or saving the plan
+	planner = RetentionPlanner.RetentionPlanner(TCMConstants.RETENTION_PLAN_PATH, get_expiry, read_only=True)
+	planner.refresh(VIDEO_PATHS)
+	plan = planner.get_plan()
+	now = time.time()
+	for expiry, path, file in plan:
+		when = datetime.datetime.fromtimestamp(expiry).strftime("%Y-%m-%d %H:%M")
+		print(f"{when}{' (due)' if expiry <= now else ''}\t{path}/{file}")
+	print(f"{len(plan)} files planned, {sum(1 for expiry, path, file in plan if expiry <= now)} due now")
+
 def extract_stamp(file):
-	match_video = ALL_VIDEO_PATTERN.match(file)
-	match_event = EVENTFILE_PATTERN.match(file)
+	# fullmatch, so a copy still in progress (<name>.part) is left alone
+	match_video = ALL_VIDEO_PATTERN.fullmatch(file)
+	match_event = EVENTFILE_PATTERN.fullmatch(file)
 	if match_video:
 		logger.debug("Returning stamp {0} for file {1}".format(match_video.group(1)[:-1], file))
 		return match_video.group(1)[:-1]
@@ -121,6 +242,16 @@ def extract_stamp(file):
 		logger.debug(f"No valid stamp found for file: {file}")
 		return None
 
+def split_video_path(path):
+	footage_folder, video_folder = path[len(TCMConstants.FOOTAGE_PATH):].rsplit("/", 1)
+	return footage_folder, video_folder
+
+def get_days_to_keep(path):
+	if not path.startswith(TCMConstants.FOOTAGE_PATH):
+		return TCMConstants.DAYS_TO_KEEP
+	footage_folder, video_folder = split_video_path(path)
+	return TCMConstants.get_days_to_keep(footage_folder.rsplit("/", 1)[-1], video_folder)
+
 def is_old_enough(stamp_in_name, path=None):
 	try:
 		stamp = datetime.datetime.strptime(stamp_in_name, TCMConstants.FILENAME_TIMESTAMP_FORMAT)
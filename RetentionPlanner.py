@@ -0,0 +1,140 @@
+# This module keeps the removal schedule for RemoveOld. The expiry time of
+# each file is worked out once, when the file is first seen, and kept in a
+# SQLite table at RETENTION_PLAN_PATH indexed by expiry, so each pass only
+# looks at the files that are actually due. A directory is listed again only
+# when its modification time changes, and only names not seen before get an
+# expiry time. Only the rows that change are written, once per pass, and the
+# schedule is reused after a restart unless DAYS_TO_KEEP or
+# RETENTION_OVERRIDES changed since it was made.
+# The catalog (FootageCatalog) keeps one expiry per stamp, the latest of its
+# folders; this schedule is per file, as Raw, Full and Fast of the same stamp
+# can expire on different days. A read-only planner works on a copy of the
+# schedule in memory, for RemoveOld --dry-run.
+
+import os
+import sqlite3
+import pathlib
+import logging
+import TCMConstants
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS files (
+	path TEXT NOT NULL,
+	name TEXT NOT NULL,
+	expires REAL,
+	PRIMARY KEY (path, name))"""
+EXPIRES_INDEX = "CREATE INDEX IF NOT EXISTS files_expires ON files (expires)"
+DIRECTORIES_SCHEMA = """CREATE TABLE IF NOT EXISTS directories (
+	path TEXT PRIMARY KEY,
+	mtime INTEGER NOT NULL)"""
+SETTINGS_SCHEMA = """CREATE TABLE IF NOT EXISTS settings (
+	name TEXT PRIMARY KEY,
+	value TEXT NOT NULL)"""
+
+class RetentionPlanner:
+
+	def __init__(self, state_path, get_expiry, read_only=False):
+		# get_expiry(path, file) returns the epoch time at which the file
+		# expires, or None if it never does
+		self.state_path = state_path
+		self.get_expiry = get_expiry
+		self.read_only = read_only
+		self.connection = None
+		self.load()
+
+	def refresh(self, paths):
+		logger = logging.getLogger(TCMConstants.get_basename())
+		for path in paths:
+			try:
+				mtime = os.stat(path).st_mtime_ns
+			except FileNotFoundError:
+				continue
+			row = self.connection.execute("SELECT mtime FROM directories WHERE path = ?", (path,)).fetchone()
+			if row and row["mtime"] == mtime:
+				continue
+			names = set(os.listdir(path))
+			known = set(row["name"] for row in self.connection.execute("SELECT name FROM files WHERE path = ?", (path,)))
+			self.begin()
+			self.connection.executemany("DELETE FROM files WHERE path = ? AND name = ?",
+				[(path, name) for name in known - names])
+			# Names without an expiry are kept too, so they are not looked at again
+			added = [(path, name, self.get_expiry(path, name)) for name in names - known]
+			self.connection.executemany("INSERT INTO files (path, name, expires) VALUES (?, ?, ?)", added)
+			self.connection.execute("INSERT OR REPLACE INTO directories (path, mtime) VALUES (?, ?)", (path, mtime))
+			logger.debug(f"Planned {sum(1 for entry in added if entry[2] is not None)} new files in {path}")
+
+	def pop_due(self, now):
+		due = [(row["path"], row["name"]) for row in self.connection.execute(
+			"SELECT path, name FROM files WHERE expires <= ? ORDER BY expires", (now,))]
+		if due:
+			self.begin()
+			self.connection.executemany("DELETE FROM files WHERE path = ? AND name = ?", due)
+		return due
+
+	def add(self, path, name, expiry=None):
+		# With no expiry given, the one worked out from the name
+		if expiry is None:
+			expiry = self.get_expiry(path, name)
+		if expiry is not None:
+			self.begin()
+			self.connection.execute("INSERT OR REPLACE INTO files (path, name, expires) VALUES (?, ?, ?)", (path, name, expiry))
+
+	def next_due(self):
+		row = self.connection.execute("SELECT MIN(expires) AS expires FROM files").fetchone()
+		return row["expires"]
+
+	def get_plan(self):
+		return [(row["expires"], row["path"], row["name"]) for row in self.connection.execute(
+			"SELECT expires, path, name FROM files WHERE expires IS NOT NULL ORDER BY expires, path, name")]
+
+	def load(self):
+		logger = logging.getLogger(TCMConstants.get_basename())
+		if self.read_only:
+			self.connection = sqlite3.connect(":memory:", isolation_level=None)
+			self.copy_saved_plan()
+		else:
+			self.connection = sqlite3.connect(self.state_path, timeout=30, isolation_level=None)
+			self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.row_factory = sqlite3.Row
+		for statement in (SCHEMA, EXPIRES_INDEX, DIRECTORIES_SCHEMA, SETTINGS_SCHEMA):
+			self.connection.execute(statement)
+		row = self.connection.execute("SELECT value FROM settings WHERE name = 'retention'").fetchone()
+		if row and row["value"] == get_retention_signature():
+			count = self.connection.execute("SELECT COUNT(*) AS count FROM files WHERE expires IS NOT NULL").fetchone()["count"]
+			logger.info(f"Loaded retention plan with {count} files")
+			return
+		if row:
+			logger.info("Retention settings changed, rebuilding the retention plan")
+		self.begin()
+		self.connection.execute("DELETE FROM files")
+		self.connection.execute("DELETE FROM directories")
+		self.connection.execute("INSERT OR REPLACE INTO settings (name, value) VALUES ('retention', ?)", (get_retention_signature(),))
+		self.save()
+
+	def copy_saved_plan(self):
+		# Nothing is written to state_path, not even when it is missing or out of date
+		try:
+			source = sqlite3.connect(f"{pathlib.Path(self.state_path).resolve().as_uri()}?mode=ro", uri=True, timeout=30)
+		except sqlite3.OperationalError:
+			return
+		try:
+			source.backup(self.connection)
+		except sqlite3.DatabaseError as e:
+			logging.getLogger(TCMConstants.get_basename()).warning(f"Unable to read retention plan {self.state_path}: {e}")
+		finally:
+			source.close()
+
+	def begin(self):
+		if not self.connection.in_transaction:
+			self.connection.execute("BEGIN")
+
+	def save(self):
+		# Writes the changes of this pass in one transaction
+		if self.connection.in_transaction:
+			self.connection.execute("COMMIT")
+
+	def discard(self):
+		if self.connection.in_transaction:
+			self.connection.execute("ROLLBACK")
+
+def get_retention_signature():
+	return repr((TCMConstants.DAYS_TO_KEEP, sorted(TCMConstants.RETENTION_OVERRIDES.items())))
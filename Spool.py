@@ -0,0 +1,54 @@
+# This module is the handoff from LoadSSD to MergeTeslaCam. When LoadSSD has
+# moved all four camera files of a stamp into Raw (and the event.json of its
+# event folder, if there is one), it writes a small JSON record into
+# SPOOL_PATH. MergeTeslaCam takes the records as its main source of work, so
+# it does not have to guess from the files in Raw whether a stamp is
+# complete. Records are written to a hidden temporary file and renamed, so a
+# reader never sees half a record. Anything that does not go through the
+# spool is still found by MergeTeslaCam's periodic scan.
+
+import os
+import json
+import logging
+import TCMConstants
+
+RECORD_SUFFIX = ".json"
+
+def post(folder, stamp, sizes):
+	if not TCMConstants.SPOOL_PATH:
+		return
+	logger = logging.getLogger(TCMConstants.get_basename())
+	name = f"{stamp}-{folder.replace('/', '_')}{RECORD_SUFFIX}"
+	record = {"folder" : folder, "stamp" : stamp, "sizes" : sizes}
+	try:
+		with open(f"{TCMConstants.SPOOL_PATH}.{name}.tmp", "w") as writer:
+			json.dump(record, writer)
+		os.replace(f"{TCMConstants.SPOOL_PATH}.{name}.tmp", f"{TCMConstants.SPOOL_PATH}{name}")
+		logger.debug(f"Posted {stamp} in {folder} to the spool")
+	except OSError as e:
+		logger.error(f"Unable to post {stamp} in {folder} to the spool: {e}")
+
+def take():
+	# Returns the waiting records, oldest stamp first, and removes them. A
+	# record lost after this is recovered by the periodic scan.
+	if not TCMConstants.SPOOL_PATH:
+		return []
+	logger = logging.getLogger(TCMConstants.get_basename())
+	records = []
+	try:
+		with os.scandir(TCMConstants.SPOOL_PATH) as entries:
+			names = sorted(item.name for item in entries if item.name.endswith(RECORD_SUFFIX) and not item.name.startswith("."))
+	except FileNotFoundError:
+		return []
+	for name in names:
+		path = f"{TCMConstants.SPOOL_PATH}{name}"
+		try:
+			with open(path, "r") as reader:
+				records.append(json.load(reader))
+		except (OSError, ValueError) as e:
+			logger.warning(f"Skipping unreadable spool record {path}: {e}")
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+	return records
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
-# This script generates an image with statistics if STATS_FILENAME is set
+# This script generates an image with statistics if STATS_FILENAME is set.
+# The image is drawn as SVG in-process by StatsSvg, or with STATS_RENDERER
+# set to 'cutycapt', rendered from stats-template.html by cutycapt under Xvfb.
 
 import os
 import time
@@ -8,50 +10,82 @@ import TCMConstants
 import subprocess
 import datetime
 import re
+import math
 import logging
+import FfmpegRunner
+import StatsSvg
+
+# Files directly in each directory counted by get_folder_details, as
+# path: (mtime, files, bytes, subdirectories, growing). A directory is only
+# listed again when its mtime changes, which happens whenever a file is
+# added, removed or renamed in it. A file growing in place (ffmpeg writes
+# its outputs under their final names) does not change the mtime of its
+# directory, so files changed in the last GROWING_SECONDS are kept in
+# growing as path: (size, mtime) and the directory is listed again when
+# one of them changes.
+directory_sizes = {}
+GROWING_SECONDS = 600
 
 def generate_stats_image():
 	logger = logging.getLogger(TCMConstants.get_basename())
 	if TCMConstants.STATS_FILENAME:
 		logger.debug(f"Generating stats in {TCMConstants.STATS_FILENAME}")
 		logger.debug(f"Footage root location: {TCMConstants.FOOTAGE_PATH}")
-		with open(f"{TCMConstants.PROJECT_PATH}/TeslaCamMerge/stats-template.html", "r") as template:
-			html = template.read()
-			logger.debug(f"Read template:\n{html}")
-			device, size, used, available, used_percentage, mount_point = get_disk_usage_details(TCMConstants.FOOTAGE_PATH)
-			directory_table_rows = get_directory_table_rows(TCMConstants.FOOTAGE_PATH)
-			service_table_rows = get_service_table_rows()
-			timestamp = datetime.datetime.now().strftime(TCMConstants.STATS_TIMESTAMP_FORMAT)
-			replacements = {
-				"DEVICE" : device,
-				"SIZE" : size,
-				"USED" : used,
-				"AVAILABLE" : available,
-				"USED_PERCENTAGE" : used_percentage,
-				"MOUNT_POINT" : mount_point,
-				"DIRECTORY_TABLE_ROWS" : directory_table_rows,
-				"SERVICE_TABLE_ROWS" : service_table_rows,
-				"TIMESTAMP" : timestamp,
-				"DISK_COLOR" : get_disk_color(used_percentage)
-			}
-			output = ""
-			for line in html.splitlines():
-				output += do_replacements(line, replacements)
-			logger.debug(f"HTML output:\n{output}")
-			with open(f"{TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME}", "w+") as file:
-				file.write(output)
-		command = f'{TCMConstants.XVFB_RUN_PATH} --server-args="-screen 0, 1280x1200x24" {TCMConstants.CUTYCAPT_PATH} --url=file://{TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME} --out={TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_IMAGE}'
-		logger.debug(f"Command: {command}")
-		completed = subprocess.run(command, shell=True, stdin=subprocess.DEVNULL,
-			stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		if completed.returncode == 0:
-			logger.info("Updated stats image")
-			try:
-				os.remove(f"{TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME}")
-			except:
-				logger.error(f"Error removing: {TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME}")
+		device, size, used, available, used_percentage, mount_point = get_disk_usage_details(TCMConstants.FOOTAGE_PATH)
+		details = {
+			"DEVICE" : device,
+			"SIZE" : size,
+			"USED" : used,
+			"AVAILABLE" : available,
+			"USED_PERCENTAGE" : used_percentage,
+			"MOUNT_POINT" : mount_point,
+			"DIRECTORY_ROWS" : get_directory_rows(TCMConstants.FOOTAGE_PATH),
+			"SERVICE_ROWS" : get_service_rows(),
+			"ENCODE_ROWS" : get_encode_rows(),
+			"TIMESTAMP" : datetime.datetime.now().strftime(TCMConstants.STATS_TIMESTAMP_FORMAT),
+			"DISK_COLOR" : get_disk_color(used_percentage)
+		}
+		if TCMConstants.STATS_RENDERER == 'cutycapt':
+			render_with_cutycapt(details)
 		else:
-			logger.error(f"Error running cutycapt command {command}, returncode: {completed.returncode}, stdout: {completed.stdout}, stderr: {completed.stderr}")
+			render_svg(details)
+
+def render_svg(details):
+	logger = logging.getLogger(TCMConstants.get_basename())
+	image = f"{TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_IMAGE}"
+	try:
+		with open(f"{image}.tmp", "w") as file:
+			file.write(StatsSvg.render(details))
+		os.replace(f"{image}.tmp", image)
+		logger.info("Updated stats image")
+	except OSError as e:
+		logger.error(f"Error writing stats image {image}: {e}")
+
+def render_with_cutycapt(details):
+	logger = logging.getLogger(TCMConstants.get_basename())
+	with open(f"{TCMConstants.PROJECT_PATH}/TeslaCamMerge/stats-template.html", "r") as template:
+		html = template.read()
+		logger.debug(f"Read template:\n{html}")
+		replacements = {name : value for name, value in details.items() if not name.endswith("_ROWS")}
+		replacements["DIRECTORY_TABLE_ROWS"] = get_directory_table_rows(details["DIRECTORY_ROWS"])
+		replacements["SERVICE_TABLE_ROWS"] = get_service_table_rows(details["SERVICE_ROWS"])
+		replacements["ENCODE_TABLE_ROWS"] = get_encode_table_rows(details["ENCODE_ROWS"])
+		output = do_replacements(html, replacements)
+		logger.debug(f"HTML output:\n{output}")
+		with open(f"{TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME}", "w+") as file:
+			file.write(output)
+	command = f'{TCMConstants.XVFB_RUN_PATH} --server-args="-screen 0, 1280x1200x24" {TCMConstants.CUTYCAPT_PATH} --url=file://{TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME} --out={TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_IMAGE}'
+	logger.debug(f"Command: {command}")
+	completed = subprocess.run(command, shell=True, stdin=subprocess.DEVNULL,
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	if completed.returncode == 0:
+		logger.info("Updated stats image")
+		try:
+			os.remove(f"{TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME}")
+		except:
+			logger.error(f"Error removing: {TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME}")
+	else:
+		logger.error(f"Error running cutycapt command {command}, returncode: {completed.returncode}, stdout: {completed.stdout}, stderr: {completed.stderr}")
 
 def get_disk_color(used_percentage):
 	used = int(used_percentage[:-1])
@@ -62,42 +96,54 @@ def get_disk_color(used_percentage):
 	else:
 		return "rgb(255, 0, 0);"
 
-def do_replacements(line, replacements):
-        substrs = sorted(replacements, key=len, reverse=True)
-        regexp = re.compile('|'.join(map(re.escape, substrs)))
-        return regexp.sub(lambda match: replacements[match.group(0)], line)
+def do_replacements(html, replacements):
+	# One pattern for the whole template, longest names first so that
+	# USED_PERCENTAGE is not taken for USED
+	substrs = sorted(replacements, key=len, reverse=True)
+	regexp = re.compile('|'.join(map(re.escape, substrs)))
+	return "".join(regexp.sub(lambda match: replacements[match.group(0)], line) for line in html.splitlines())
 
-def get_directory_table_rows(path):
-	output = ""
+### Table rows, as data for the SVG renderer and as HTML for cutycapt ###
+
+def get_directory_rows(path):
+	# (name, level, number of files, size) for each row of the Video Files table
+	rows = []
 	for item in os.listdir(path):
 		if item == TCMConstants.STATS_FILENAME or item == TCMConstants.STATS_IMAGE:
 			continue
 		num_files, total_size = get_folder_details(path, item)
-		output += f"<tr><td>{item}</td><td class='number'>{num_files:,d}</td><td class='number'>{total_size}</td></tr>"
+		rows.append((item, 0, num_files, total_size))
 		if TCMConstants.MULTI_CAR and item in TCMConstants.CAR_LIST and num_files > 0:
 			for folder in TCMConstants.FOOTAGE_FOLDERS:
 				sub_files, sub_size = get_folder_details(f"{path}/{item}", folder)
-				output += f"<tr><td class='small'>&nbsp;&nbsp;{folder}</td><td class='smallnumber'>{sub_files:,d}</td><td class='smallnumber'>{sub_size}</td></tr>"
+				rows.append((folder, 1, sub_files, sub_size))
 				if sub_files > 0:
-					output += get_subdirectory_table_rows(f"{path}/{item}/{folder}", "&nbsp;&nbsp;&nbsp;&nbsp;", "smaller")
+					rows += get_subdirectory_rows(f"{path}/{item}/{folder}", 2)
 		else:
 			if item in TCMConstants.FOOTAGE_FOLDERS and num_files > 0:
-				output += get_subdirectory_table_rows(f"{path}/{item}", "&nbsp;&nbsp;", "small")
-	return output
+				rows += get_subdirectory_rows(f"{path}/{item}", 1)
+	return rows
+
+def get_subdirectory_rows(path, level):
+	rows = []
+	for folder in (TCMConstants.RAW_FOLDER, TCMConstants.FULL_FOLDER, TCMConstants.FAST_FOLDER):
+		num_files, total_size = get_folder_details(path, folder)
+		rows.append((folder, level, num_files, total_size))
+	return rows
 
-def get_subdirectory_table_rows(path, indent, font_class):
+def get_directory_table_rows(rows):
 	output = ""
-	raw_files, raw_size = get_folder_details(path, TCMConstants.RAW_FOLDER)
-	output += f"<tr><td class='{font_class}'>{indent}{TCMConstants.RAW_FOLDER}</td><td class='{font_class}number'>{raw_files:,d}</td><td class='{font_class}number'>{raw_size}</td></tr>"
-	full_files, full_size = get_folder_details(path, TCMConstants.FULL_FOLDER)
-	output += f"<tr><td class='{font_class}'>{indent}{TCMConstants.FULL_FOLDER}</td><td class='{font_class}number'>{full_files:,d}</td><td class='{font_class}number'>{full_size}</td></tr>"
-	fast_files, fast_size = get_folder_details(path, TCMConstants.FAST_FOLDER)
-	output += f"<tr><td class='{font_class}'>{indent}{TCMConstants.FAST_FOLDER}</td><td class='{font_class}number'>{fast_files:,d}</td><td class='{font_class}number'>{fast_size}</td></tr>"
+	for name, level, num_files, total_size in rows:
+		font_class = ["", "small", "smaller"][level]
+		number_class = f"{font_class}number" if font_class else "number"
+		name_class = f" class='{font_class}'" if font_class else ""
+		output += f"<tr><td{name_class}>{'&nbsp;&nbsp;' * level}{name}</td><td class='{number_class}'>{num_files:,d}</td><td class='{number_class}'>{total_size}</td></tr>"
 	return output
 
-def get_service_table_rows():
+def get_service_rows():
+	# (name, running) for each service
 	command = f"{TCMConstants.SYSTEMCTL_PATH} show -p Id -p Name -p SubState --value tcm-*"
-	output = get_service_details(command)
+	rows = get_service_details(command)
 	creds = ""
 	try:
 		import DownloadTC
@@ -106,11 +152,11 @@ def get_service_table_rows():
 		logging.getLogger(TCMConstants.get_basename()).debug("No TCM2ndHome connected")
 	if creds:
 		command = f"{TCMConstants.SYSTEMCTL_PATH} show -p Id -p Name -p SubState --value tcm2-* -H {creds}"
-		output += get_service_details(command)
-	return output
+		rows += get_service_details(command)
+	return rows
 
 def get_service_details(command):
-	output = ""
+	rows = []
 	completed = subprocess.run(command, shell=True, stdin=subprocess.DEVNULL,
 		stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 	if completed.stderr or completed.returncode != 0:
@@ -122,36 +168,125 @@ def get_service_details(command):
 		while i < len(lines):
 			if i % 3 == 0:
 				name = lines[i].decode("UTF-8").split(".")[0]
-				service_class = ""
-				if lines[i+1].decode("UTF-8") == "running":
-					service_class = "servicerunning"
-				else:
-					service_class = "servicedead"
-				output += f"<tr><td class='{service_class}'>{name}</td></tr>"
+				rows.append((name, lines[i+1].decode("UTF-8") == "running"))
 			i += 1
+	return rows
+
+def get_service_table_rows(rows):
+	output = ""
+	for name, running in rows:
+		service_class = "servicerunning" if running else "servicedead"
+		output += f"<tr><td class='{service_class}'>{name}</td></tr>"
+	return output
+
+def get_encode_rows():
+	# (description, fps, speed) for each encode in flight
+	rows = []
+	if TCMConstants.FFMPEG_PROGRESS_PATH:
+		progress = FfmpegRunner.read_progress()
+		# A file that stopped updating was left behind by a MergeTeslaCam that is not running
+		if time.time() - progress["updated"] < TCMConstants.FFMPEG_STALL_TIMEOUT:
+			for job in progress["jobs"].values():
+				rows.append((job['description'], f"{job['fps']} fps", job['speed']))
+	return rows
+
+def get_encode_table_rows(rows):
+	output = ""
+	for description, fps, speed in rows:
+		output += f"<tr><td class='small'>{description}</td><td class='smallnumber'>{fps}</td><td class='smallnumber'>{speed}</td></tr>"
+	if not output:
+		output = "<tr><td class='small'>None</td></tr>"
 	return output
 
 def get_folder_details(path, file):
-	total_size = 0
-	num_files = 0
-	for dirpath, dirnames, filenames in os.walk(f"{path}/{file}"):
-		for f in filenames:
-			fp = os.path.join(dirpath, f)
-			# Skip symbolic links
-			if not os.path.islink(fp):
-				total_size += os.path.getsize(fp)
-				num_files += 1
+	num_files, total_size = get_tree_totals(f"{path}/{file}")
 	return num_files, TCMConstants.convert_file_size(total_size)
 
+def get_tree_totals(path):
+	try:
+		mtime = os.stat(path).st_mtime_ns
+	except FileNotFoundError:
+		forget_directory(path)
+		return 0, 0
+	cached = directory_sizes.get(path)
+	if cached and cached[0] == mtime and not files_have_changed(cached[4]):
+		num_files, total_size, subdirectories = cached[1:4]
+	else:
+		num_files = total_size = 0
+		subdirectories = []
+		growing = {}
+		recent = time.time_ns() - GROWING_SECONDS * 1000000000
+		try:
+			with os.scandir(path) as entries:
+				for entry in entries:
+					# Skip symbolic links, and do not follow them into directories
+					if entry.is_symlink():
+						continue
+					if entry.is_dir(follow_symlinks=False):
+						subdirectories.append(entry.path)
+					else:
+						try:
+							stat = entry.stat(follow_symlinks=False)
+						except FileNotFoundError:
+							continue
+						total_size += stat.st_size
+						num_files += 1
+						if stat.st_mtime_ns > recent:
+							growing[entry.path] = (stat.st_size, stat.st_mtime_ns)
+		except FileNotFoundError:
+			forget_directory(path)
+			return 0, 0
+		if cached:
+			for subdirectory in cached[3]:
+				if subdirectory not in subdirectories:
+					forget_directory(subdirectory)
+		directory_sizes[path] = (mtime, num_files, total_size, subdirectories, growing)
+	for subdirectory in subdirectories:
+		sub_files, sub_size = get_tree_totals(subdirectory)
+		num_files += sub_files
+		total_size += sub_size
+	return num_files, total_size
+
+def files_have_changed(growing):
+	for path, (size, mtime) in growing.items():
+		try:
+			stat = os.stat(path, follow_symlinks=False)
+		except FileNotFoundError:
+			return True
+		if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+			return True
+	return False
+
+def forget_directory(path):
+	for cached_path in [cached_path for cached_path in directory_sizes if cached_path == path or cached_path.startswith(f"{path}/")]:
+		del directory_sizes[cached_path]
+
 def get_disk_usage_details(footage_path):
 	logger = logging.getLogger(TCMConstants.get_basename())
-	command = f"{TCMConstants.DF_PATH} -h {footage_path}"
-	completed = subprocess.run(command, shell=True, stdin=subprocess.DEVNULL,
-		stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	if completed.stderr or completed.returncode != 0:
-		logger.error(f"Error running df command, returncode: {completed.returncode}, stdout: {completed.stdout}, stderr: {completed.stderr}")
+	try:
+		size, used, available = TCMConstants.get_disk_usage(footage_path)
+	except OSError as e:
+		logger.error(f"Error reading disk usage of {footage_path}: {e}")
 		return None, None, None, None, None, None
-	else:
-		logger.debug("Disk space raw result:\n{0}".format(completed.stdout.decode("UTF-8")))
-		line = completed.stdout.decode("UTF-8").splitlines()[1]
-		return re.split("\s+", line)
+	device, mount_point = get_mount(footage_path)
+	used_percentage = f"{math.ceil(100 * used / (used + available)) if used + available else 0}%"
+	logger.debug(f"Disk space: {device} {size} {used} {available} {used_percentage} {mount_point}")
+	return (device, TCMConstants.convert_file_size(size).strip(), TCMConstants.convert_file_size(used).strip(),
+		TCMConstants.convert_file_size(available).strip(), used_percentage, mount_point)
+
+def get_mount(path):
+	# The longest mount point in /proc/self/mounts that contains path
+	path = os.path.realpath(path)
+	device, mount_point = "", "/"
+	try:
+		with open("/proc/self/mounts", "r") as mounts:
+			for line in mounts:
+				fields = line.split()
+				if len(fields) < 2:
+					continue
+				candidate = fields[1].replace("\\040", " ")
+				if (path == candidate or path.startswith(candidate.rstrip("/") + "/")) and len(candidate) >= len(mount_point):
+					device, mount_point = fields[0], candidate
+	except OSError:
+		pass
+	return device, mount_point
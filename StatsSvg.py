@@ -0,0 +1,93 @@
+# This module draws the stats page as an SVG image, with the same tables as
+# stats-template.html: video files per folder, services, encodes in flight
+# and disk space. It needs nothing outside the standard library, so Stats
+# does not have to start Xvfb and a browser to make the image.
+
+from xml.sax.saxutils import escape
+
+WIDTH = 1280
+MARGIN = 20
+PADDING = 12
+RIGHT_COLUMN = 680
+FONT = "Arial, Helvetica, sans-serif"
+RUNNING_COLOR = "rgb(0, 255, 0)"
+DEAD_COLOR = "rgb(255, 0, 0)"
+
+# Font size for each level of the Video Files table, as the td, td.small and
+# td.smaller classes in the template
+LEVEL_FONT_SIZES = [16, 14, 12]
+
+def render(details):
+	elements = []
+	y = MARGIN + 32
+	elements.append(text(MARGIN, y, "Footage Details", 32, bold=True))
+	top = y + 24
+
+	y = heading(elements, MARGIN, top, "Video Files")
+	rows = [[(name if level == 0 else f"{'  ' * level}{name}", LEVEL_FONT_SIZES[level], None),
+		(f"{num_files:,d}", LEVEL_FONT_SIZES[level], None),
+		(total_size.strip(), LEVEL_FONT_SIZES[level], None)]
+		for name, level, num_files, total_size in details["DIRECTORY_ROWS"]]
+	left_bottom = table(elements, MARGIN, y, [(300, "start"), (110, "end"), (130, "end")], ["Folder", "#", "Size"], rows)
+
+	y = heading(elements, RIGHT_COLUMN, top, "Services")
+	rows = [[(name, 16, RUNNING_COLOR if running else DEAD_COLOR)] for name, running in details["SERVICE_ROWS"]]
+	y = table(elements, RIGHT_COLUMN, y, [(260, "middle")], None, rows)
+	y = heading(elements, RIGHT_COLUMN, y + 8, "Encodes")
+	rows = [[(description, 14, None), (fps, 14, None), (speed, 14, None)] for description, fps, speed in details["ENCODE_ROWS"]]
+	if not rows:
+		rows = [[("None", 14, None)]]
+	right_bottom = table(elements, RIGHT_COLUMN, y, [(360, "start"), (100, "end"), (100, "end")], None, rows)
+
+	y = heading(elements, MARGIN, max(left_bottom, right_bottom) + 16, "Disk Space Details")
+	disk_color = (details["DISK_COLOR"] or "").rstrip(";") or None
+	rows = [[(details["DEVICE"], 16, None), (details["SIZE"], 16, None), (details["USED"], 16, None),
+		(details["AVAILABLE"], 16, None), (details["USED_PERCENTAGE"], 16, disk_color), (details["MOUNT_POINT"], 16, None)]]
+	y = table(elements, MARGIN, y, [(220, "start"), (100, "end"), (100, "end"), (100, "end"), (80, "end"), (220, "start")],
+		["Filesystem", "Size", "Used", "Avail", "Use%", "Mount"], rows)
+
+	y += 28
+	elements.append(text(MARGIN, y, f"Generated at {details['TIMESTAMP']}", 12))
+	height = y + MARGIN
+	return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{WIDTH}" height="{height}" viewBox="0 0 {WIDTH} {height}">'
+		f'<rect width="100%" height="100%" fill="white"/>'
+		f'<g font-family="{FONT}" fill="black">{"".join(elements)}</g></svg>\n')
+
+def heading(elements, x, y, title):
+	y += 24 + 16
+	elements.append(text(x, y, title, 24, bold=True))
+	return y + 16
+
+def table(elements, x, y, columns, header, rows):
+	# columns is a list of (width, text-anchor), and each row a list of
+	# (text, font size, background color) cells. Returns the y below the table.
+	if header:
+		y = table_row(elements, x, y, columns, [(title, 16, None) for title in header], bold=True)
+	for row in rows:
+		y = table_row(elements, x, y, columns, row)
+	return y
+
+def table_row(elements, x, y, columns, cells, bold=False):
+	height = max(size for value, size, color in cells) + 2 * PADDING
+	for (width, anchor), (value, size, color) in zip(columns, cells):
+		elements.append(f'<rect x="{x}" y="{y}" width="{width}" height="{height}" fill="{color or "none"}" stroke="black"/>')
+		if anchor == "end":
+			text_x = x + width - PADDING
+		elif anchor == "middle":
+			text_x = x + width // 2
+		else:
+			text_x = x + PADDING
+		value = fit("" if value is None else str(value), width - 2 * PADDING, size)
+		elements.append(text(text_x, y + PADDING + size * 0.85, value, size, bold, anchor))
+		x += width
+	return y + height
+
+def fit(value, width, size):
+	# Shortens text that would run out of its cell, taking an average
+	# character as a little over half the font size wide
+	limit = max(int(width / (size * 0.55)), 1)
+	return value if len(value) <= limit else f"{value[:limit - 1]}…"
+
+def text(x, y, value, size, bold=False, anchor="start"):
+	weight = ' font-weight="bold"' if bold else ""
+	return f'<text x="{x}" y="{y:.0f}" font-size="{size}"{weight} text-anchor="{anchor}" xml:space="preserve">{escape(value)}</text>'
@@ -5,6 +5,10 @@ import subprocess
 import re
 import sys
 import signal
+import time
+import threading
+import fcntl
+import shutil
 
 # Location where the TeslaCamMerge directory is present. Must NOT include trailing /.
 PROJECT_PATH = '/home/pavan'	# Must contain the directory called TeslaCamMerge (where you cloned this repository), as well as filebrowser.db
@@ -37,6 +41,40 @@ FOOTAGE_FOLDERS = ['SavedClips', 'SentryClips', 'RecentClips']
 # Root location of all footage used and created by the application. MUST include trailing /.
 FOOTAGE_PATH = '/home/pavan/Footage/'
 
+# SQLite catalog of all stamps in the footage folders, shared by the services
+# so they do not rescan the whole footage tree every loop. PROJECT_USER needs
+# read-write permissions on this file and the directory it is in.
+# MergeTeslaCam rebuilds the catalog from the files on disk at startup and
+# every CATALOG_RECONCILE_INTERVAL seconds after that.
+CATALOG_PATH = '/home/pavan/footage.db'
+CATALOG_RECONCILE_INTERVAL = 3600
+
+# LoadSSD drops a small record here for every stamp it has finished moving
+# into Raw, and MergeTeslaCam picks these up to start merges right away.
+# MUST include trailing /, PROJECT_USER needs read-write permissions. Set to
+# None to have MergeTeslaCam find new stamps by scanning as before.
+SPOOL_PATH = '/home/pavan/spool/'
+
+# MergeTeslaCam writes the progress of its running encodes here for the stats
+# page. Set to None to not write it.
+FFMPEG_PROGRESS_PATH = '/home/pavan/ffmpeg-progress.json'
+
+# RemoveOld keeps the time at which each video file expires in this SQLite
+# file, so it does not have to work it out again for every file on every loop
+# or after a restart. PROJECT_USER needs read-write permissions on this file
+# and the directory it is in. It is rebuilt if DAYS_TO_KEEP or
+# RETENTION_OVERRIDES change. Run "RemoveOld.py --dry-run" to list what will
+# be removed and when.
+RETENTION_PLAN_PATH = '/home/pavan/retention-plan.db'
+
+# Each service writes its metrics (queue depth, ffmpeg time and fps, file
+# checks, bytes ingested, uploaded and removed) in the Prometheus text format
+# to a <service>.prom file here, for the textfile collector of node_exporter.
+# MUST include trailing /. It is created if missing, PROJECT_USER needs
+# permission to create it or read-write permissions on it. Set to None to not
+# write metrics.
+METRICS_PATH = '/home/pavan/metrics/'
+
 # This app can handle footage from multiple cars with Tesla dashcam features.
 # If you have more than one Tesla, set MULTI_CAR to True and set up the names
 # of the folders for the footage in CAR_LIST. For example, you may want paths
@@ -58,6 +96,34 @@ SHARE_PATHS = ['/samba/fjnuser/']
 # Any subdirectory must already exist on Google Drive.
 UPLOAD_REMOTE_PATH = 'gdrive:/TeslaCam'
 
+# UploadDrive hands all the files waiting in UPLOAD_LOCAL_PATH to a single
+# rclone run, uploading UPLOAD_TRANSFERS files at the same time, instead of
+# starting rclone once per file. The state of each file is kept in
+# UPLOAD_QUEUE_PATH (PROJECT_USER needs read-write permissions on it and its
+# directory). A file that fails is tried again after UPLOAD_RETRY_DELAY
+# seconds, twice as long after each further failure, up to
+# UPLOAD_RETRY_MAX_DELAY. Set UPLOAD_BATCH to False to upload one file at a
+# time as before. To try this out without Google Drive, set
+# UPLOAD_REMOTE_PATH to a local directory (rclone's local backend), or run
+# tools/check_upload_batch.py.
+UPLOAD_BATCH = True
+UPLOAD_TRANSFERS = 4
+UPLOAD_QUEUE_PATH = '/home/pavan/upload-queue.json'
+UPLOAD_RETRY_DELAY = 60
+UPLOAD_RETRY_MAX_DELAY = 3600
+
+# With UPLOAD_BATCH set, UploadDrive also keeps the content hash of every
+# file it uploads in UPLOAD_INDEX_PATH (PROJECT_USER needs read-write
+# permissions on it and its directory). A new file with the same content as
+# an earlier upload is not uploaded again: with UPLOAD_DEDUP set to 'skip' it
+# is only removed locally, and with 'copy' the earlier upload is copied to
+# the new name on the remote (server-side where the remote supports it).
+# Either way the local file is only removed once rclone reports the same size
+# and MD5 on the remote, so a remote without MD5 hashes gets every file.
+# Set UPLOAD_DEDUP to None to upload every file.
+UPLOAD_DEDUP = 'copy'
+UPLOAD_INDEX_PATH = '/home/pavan/upload-index.json'
+
 # Number of days to keep videos: applies to raw, full and fast videos.
 # Videos that are older than these and in the FULL_PATH, FAST_PATH and
 # RAW_PATH locations are automatically deleted by removeOld.service
@@ -80,18 +146,39 @@ RETENTION_OVERRIDES = {
 	('SavedClips', 'Fast'): 90,
 }
 
+# Free-space watermarks for removeOld.service. When the footage disk is more
+# than DISK_HIGH_WATERMARK percent full, RemoveOld removes files before their
+# retention is up: folders in EVICTION_ORDER first to last, oldest stamp
+# first within each, EVICTION_BATCH files at a time, until the disk is below
+# DISK_LOW_WATERMARK percent. SavedClips is never evicted, even if listed.
+# Set DISK_HIGH_WATERMARK to None to only remove files by age.
+DISK_HIGH_WATERMARK = 90
+DISK_LOW_WATERMARK = 80
+EVICTION_ORDER = [
+	('RecentClips', 'Raw'),
+	('RecentClips', 'Full'),
+	('RecentClips', 'Fast'),
+	('SentryClips', 'Raw'),
+	('SentryClips', 'Full'),
+	('SentryClips', 'Fast'),
+]
+EVICTION_BATCH = 200
+
 # Filename for an html file with statistics about TeslaCamMerge.
 # If STATS_FILENAME is not empty, the application will generate a
 # file in the footage directory (i.e. one level up from RAW_PATH)
 # that shows how many videos are in which folder, and the overall
-# disk usage. It then converts the HTML into an image using
-# cutycapt. If the image is successfully created, it then deletes
-# the HTML file. Stats are generated when current timestamp's minute
-# matches one of the values in STATS_FREQUENCY, so if you want
-# stats updated more frequently, add more numbers between 0 and
-# 59 to the list.
+# disk usage. With STATS_RENDERER set to 'svg', the image is drawn
+# directly as an SVG file named STATS_IMAGE. With STATS_RENDERER set to
+# 'cutycapt', the HTML is converted into an image using cutycapt (and
+# xvfb-run), and STATS_IMAGE should end in .png. If the image is
+# successfully created, it then deletes the HTML file. Stats are
+# generated when current timestamp's minute matches one of the
+# values in STATS_FREQUENCY, so if you want stats updated more
+# frequently, add more numbers between 0 and 59 to the list.
 STATS_FILENAME = 'stats.html'
-STATS_IMAGE = 'stats.png'
+STATS_RENDERER = 'svg'
+STATS_IMAGE = 'stats.svg'
 STATS_FREQUENCY = [0, 30]
 STATS_TIMESTAMP_FORMAT = '%-I:%M %p on %a %b %-d, %Y'
 
@@ -114,7 +201,6 @@ FFMPEG_PATH = '/usr/bin/ffmpeg'							# Verify with: which ffmpeg
 RCLONE_PATH = '/usr/local/bin/rclone --log-file /home/pavan/log/rclone.log'	# Verify with: which rclone
 FILEBROWSER_PATH = '/usr/local/bin/filebrowser'					# Verify with: which filebrowser
 LSOF_PATH = '/usr/bin/lsof -t'							# Verify with: which lsof
-DF_PATH = '/bin/df'								# Verify with: which df
 CUTYCAPT_PATH = '/usr/bin/cutycapt --zoom-factor=1.5'				# Verify with: which cutycapt
 SYSTEMCTL_PATH = "/bin/systemctl"						# Verify with: which systemctl
 XVFB_RUN_PATH = '/usr/bin/xvfb-run'						# Verify with: which xvfb-run
@@ -135,9 +221,84 @@ BAD_FASTPREVIEW_FILENAME = "bad_fastpreview.txt"
 
 # Options: 'auto', 'intel', 'nvidia', 'amd', 'software', or 'bullwinkle' because all the 
 # script sees today is 'intel' or not 'intel.' Do not try 'hotdog' it will only be not-hotdog.
-# intel will attempt to use an intel GPU. Anything else will use CPU encoding. 
+# intel will attempt to use an intel GPU. auto will benchmark the available
+# encoders once and use the fastest (see below). Anything else will use CPU encoding.
 FFMPEG_ENCODER_PREFERENCE = 'intel'
 
+# With FFMPEG_ENCODER_PREFERENCE = 'auto', MergeTeslaCam benchmarks every
+# encoder it can use (Intel/AMD VAAPI, Nvidia NVENC, and libx264 presets and
+# thread counts) on a CALIBRATION_SECONDS synthetic clip at startup and picks
+# the fastest. libx264 presets whose output is more than
+# CALIBRATION_SIZE_BUDGET times bigger than the smallest one are not used.
+# Results are saved in CALIBRATION_CACHE_PATH and reused until ffmpeg or the
+# CPU changes. Delete that file to calibrate again.
+CALIBRATION_CACHE_PATH = '/home/pavan/encoder-calibration.json'
+CALIBRATION_SECONDS = 5
+CALIBRATION_SIZE_BUDGET = 1.5
+
+# Number of encodes MergeTeslaCam runs at the same time. Full merges use the
+# encoder chosen above (e.g. the Intel GPU) and fast previews always use
+# libx264, so each kind of encode gets its own slots and they can overlap.
+MERGE_FULL_SLOTS = 1
+MERGE_FAST_SLOTS = 1
+
+# Order in which waiting merges and fast previews are started. Folders with a
+# lower number go first, and within a folder the newest stamp goes first. A
+# job that has waited PRIORITY_AGING_SECONDS counts as one step more urgent,
+# so RecentClips still gets merged while SentryClips keeps coming in.
+# Folders not listed here get the highest number in the list.
+FOLDER_PRIORITY = {'SavedClips': 0, 'SentryClips': 0, 'RecentClips': 1}
+PRIORITY_AGING_SECONDS = 1800
+
+# Decode the four cameras once and write the full and the fast video from
+# the same frames in a single ffmpeg run (in a MERGE_FULL_SLOTS slot). If the
+# single run fails, MergeTeslaCam falls back to the separate merge and fast
+# preview. Set to False to always use the two separate steps.
+FFMPEG_SINGLE_PASS = True
+
+# How the fast preview is made. FAST_PREVIEW_SPEED is how many times faster
+# than real time it plays.
+#   'setpts'    - keep every frame and only retime them (the original method;
+#                 libx264 has to encode every frame of the full video)
+#   'fps'       - retime, then keep only FAST_PREVIEW_FPS frames per second of
+#                 preview, so far fewer frames are encoded
+#   'keyframes' - decode only the keyframes of the full video, then retime and
+#                 output FAST_PREVIEW_FPS frames per second. Cheapest, but the
+#                 choppiest. With FFMPEG_SINGLE_PASS the frames are already
+#                 decoded, so this behaves like 'fps' there.
+FAST_PREVIEW_MODE = 'setpts'
+FAST_PREVIEW_SPEED = 11
+FAST_PREVIEW_FPS = 30
+
+# LoadSSD copies up to INGEST_WORKERS files from the share at the same time.
+# Each copy is checked against the size of the source, and also against its
+# hash with INGEST_VERIFY_HASH (this reads both files once more). Copies are
+# flushed to disk in groups of INGEST_FSYNC_BATCH before the sources are
+# deleted from the share.
+INGEST_WORKERS = 4
+INGEST_VERIFY_HASH = False
+INGEST_FSYNC_BATCH = 16
+
+# Join the full and fast files of all the stamps that belong to one event
+# (matched to its event.json within EVENT_DURATION) into one
+# <event stamp>-eventfull.mp4 and <event stamp>-eventfast.mp4, using the
+# ffmpeg concat demuxer with stream copy (no re-encoding). An event is only
+# stitched once all of its stamps are merged and previewed (or bad), and is
+# stitched again when a stamp that was not in it yet has been previewed. A
+# stamp still missing camera files holds up the stitch for at most
+# STITCH_INCOMPLETE_WAIT seconds.
+STITCH_EVENTS = True
+STITCH_INCOMPLETE_WAIT = 900
+
+# Event-driven mode: LoadSSD, MergeTeslaCam and UploadDrive wake up as soon as
+# inotify reports new files in the share, Raw and Upload folders instead of
+# polling every SLEEP_DURATION seconds. A full scan still runs every
+# FULL_SCAN_INTERVAL seconds as a safety net. Work that could not be done yet
+# (a file still being written, a failed move or upload) is tried again after
+# SLEEP_DURATION seconds. Set to False to poll as before.
+EVENT_DRIVEN = True
+FULL_SCAN_INTERVAL = 900
+
 
 ### Do not modify anything below this line ###
 
@@ -148,6 +309,8 @@ RIGHT_TEXT = 'right_repeater.mp4'
 BACK_TEXT = 'back.mp4'
 FULL_TEXT = 'full.mp4'
 FAST_TEXT = 'fast.mp4'
+EVENT_FULL_TEXT = 'eventfull.mp4'
+EVENT_FAST_TEXT = 'eventfast.mp4'
 FILENAME_TIMESTAMP_FORMAT = '%Y-%m-%d_%H-%M-%S'
 FILENAME_REGEX  = '(\d{4}(-\d\d){2}_(\d\d-){3})(right_repeater|front|left_repeater|back).mp4'
 FILENAME_PATTERN = re.compile(FILENAME_REGEX)
@@ -176,9 +339,19 @@ EVENT_CAMERA = {'0' : 'front camera',
 
 # Application management constants
 SLEEP_DURATION = 60             # Seconds between looping in main tasks
+OPEN_FILES_MIN_AGE = 1          # Minimum seconds between two scans of open files in /proc
+BAD_LIST_COMPACT_DELAY = 30     # Seconds after an entry is appended to a bad list before the file is sorted again
+SHARE_STABLE_SECONDS = 60       # Seconds a file on the share must stay unchanged across LoadSSD scans before it is moved without an open-file check
+INOTIFY_SETTLE = 2              # Seconds without new inotify events before an event-driven loop runs
+INOTIFY_SETTLE_MAX = 10         # Most seconds an event-driven loop waits for a steady stream of inotify events to settle
 SPECIAL_EXIT_CODE = 115         # Exit code used by the app, has to be non-zero for systemctl to auto-restart crashed services
 SIZE_RANGE = 0.99               # Maximum size difference in percentage between video files, timsestamps with bigger size differences are not merged
+FICLONE = 0x40049409            # ioctl request for a reflink copy, from linux/fs.h
 FFMPEG_TIMELIMIT = 9000         # CPU time limit in seconds for FFMPEG commands to run
+FFMPEG_STALL_TIMEOUT = 300      # Wall-clock seconds without a new encoded frame before an FFMPEG command is killed
+FFMPEG_PROGRESS_LOG_INTERVAL = 60       # Seconds between progress lines in the log for a running FFMPEG command
+FFMPEG_PROGRESS_WRITE_INTERVAL = 5      # Seconds between updates of FFMPEG_PROGRESS_PATH
+METRICS_WRITE_INTERVAL = 15     # Seconds between updates of the files in METRICS_PATH
 
 # Common functions
 
@@ -212,7 +385,59 @@ def check_file_for_read(file):
 						"File {0} does not exist".format(file))
 				return False
 
+# Snapshot of every path held open by a process we can see, taken by scanning
+# /proc/*/fd once per loop instead of running lsof once per file
+open_files = None
+open_files_time = 0
+open_files_lock = threading.RLock()
+
+def refresh_open_files():
+		global open_files, open_files_time
+		with open_files_lock:
+				scan_time = time.time()
+				try:
+						pids = [pid for pid in os.listdir("/proc") if pid.isdigit()]
+				except OSError as e:
+						logging.getLogger(get_basename()).debug(f"Unable to scan /proc, falling back to lsof: {e}")
+						open_files = None
+						return
+				paths = set()
+				for pid in pids:
+						fd_path = f"/proc/{pid}/fd"
+						try:
+								fds = os.listdir(fd_path)
+						except OSError:
+								continue
+						for fd in fds:
+								try:
+										paths.add(os.readlink(f"{fd_path}/{fd}"))
+								except OSError:
+										continue
+				open_files = paths
+				open_files_time = scan_time
+
 def file_being_written(file):
+		with open_files_lock:
+				try:
+						modified = os.stat(file).st_mtime
+				except OSError:
+						return True # abundance of caution: if the file can't be checked, say it is not ready for read
+				# A file changed after the snapshot may have been opened after it too
+				if open_files is None or modified >= open_files_time:
+						wait = OPEN_FILES_MIN_AGE - (time.time() - open_files_time)
+						if open_files is not None and wait > 0:
+								time.sleep(wait)
+						refresh_open_files()
+						if open_files is None:
+								return lsof_file_being_written(file)
+						if modified >= open_files_time:
+								return True
+				if os.path.realpath(file) in open_files:
+						logging.getLogger(get_basename()).debug("File {0} in use".format(file))
+						return True
+				return False
+
+def lsof_file_being_written(file):
 		logger = logging.getLogger(get_basename())
 		completed = subprocess.run("{0} {1}".format(LSOF_PATH, file), shell=True,
 				stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -256,6 +481,45 @@ def get_logger():
 		signal.signal(signal.SIGTERM, exit_gracefully)
 		return logger
 
+def get_days_to_keep(footage_folder, video_folder):
+		return RETENTION_OVERRIDES.get((footage_folder, video_folder), DAYS_TO_KEEP)
+
+def link_or_copy(source, destination):
+		# Give destination the same content as source without writing the bytes
+		# again where possible: a hard link, then a reflink (FICLONE, on btrfs
+		# and XFS), and only then a full copy. Each name can still be removed
+		# on its own. Returns the method that was used.
+		try:
+				os.link(source, destination)
+				return "hardlink"
+		except OSError:
+				pass
+		try:
+				with open(source, "rb") as reader, open(destination, "wb") as writer:
+						fcntl.ioctl(writer.fileno(), FICLONE, reader.fileno())
+				return "reflink"
+		except OSError:
+				try:
+						os.remove(destination)
+				except OSError:
+						pass
+		shutil.copyfile(source, destination)
+		return "copy"
+
+def get_disk_usage(path):
+		# Total, used and available bytes like df reports them, from statvfs
+		stat = os.statvfs(path)
+		total = stat.f_blocks * stat.f_frsize
+		used = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+		available = stat.f_bavail * stat.f_frsize
+		return total, used, available
+
+def get_used_percentage(path):
+		total, used, available = get_disk_usage(path)
+		if used + available == 0:
+				return 0
+		return 100 * used / (used + available)
+
 def get_basename():
 		return os.path.splitext(os.path.basename(sys.argv[0]))[0]
 
@@ -1,27 +1,64 @@
 #!/usr/bin/env python3
 
 # This script uploads files placed in UPLOAD_LOCAL_PATH on the
-# computer to the UPLOAD_REMOTE_PATH location using rclone.
+# computer to the UPLOAD_REMOTE_PATH location using rclone. With
+# EVENT_DRIVEN set, it wakes up as soon as a file lands in the folder.
+# With UPLOAD_BATCH set, all the files waiting are handed to a single
+# rclone run (UPLOAD_TRANSFERS at a time), and the state of each file is
+# kept in UploadQueue so a failed upload is retried with a growing delay.
+# With UPLOAD_DEDUP also set, a file whose content was uploaded before
+# (UploadIndex) is not sent again: it is skipped, or copied on the remote
+# from the earlier upload.
 
 import os
+import json
 import time
+import shlex
+import tempfile
 import subprocess
 import TCMConstants
+import Inotify
+import Metrics
+import UploadQueue
+import UploadIndex
 
 logger = TCMConstants.get_logger()
 
 def main():
 	files = []
+	watcher = Inotify.Watcher([TCMConstants.UPLOAD_LOCAL_PATH])
+	queue = UploadQueue.UploadQueue(TCMConstants.UPLOAD_QUEUE_PATH) if TCMConstants.UPLOAD_BATCH else None
+	index = UploadIndex.UploadIndex(TCMConstants.UPLOAD_INDEX_PATH) if queue is not None and TCMConstants.UPLOAD_DEDUP else None
 	while True:
 		try:
 			files = os.listdir(TCMConstants.UPLOAD_LOCAL_PATH)
 		except:
 			logger.error("Error listing directory {0}".format(TCMConstants.UPLOAD_LOCAL_PATH))
-			TCMConstants.exit_gracefully(TCMConstants.SPECIAL_EXIT_CODE)
+			TCMConstants.exit_gracefully(TCMConstants.SPECIAL_EXIT_CODE, None)
 
-		for file in files:
-			upload_file(file)
-		time.sleep(TCMConstants.SLEEP_DURATION)
+		if queue is None:
+			for file in files:
+				upload_file(file)
+		else:
+			upload_batch(queue, files, index)
+		Metrics.write(force=True)
+		watcher.wait(get_wait_time(queue))
+
+def get_wait_time(queue):
+	# Wake up in time for the next retry of a failed upload
+	wait = TCMConstants.FULL_SCAN_INTERVAL
+	if queue is None:
+		# Files rclone could not upload are still here, try them again soon
+		try:
+			if os.listdir(TCMConstants.UPLOAD_LOCAL_PATH):
+				wait = TCMConstants.SLEEP_DURATION
+		except OSError:
+			pass
+		return wait
+	next_try = queue.next_try()
+	if next_try is not None:
+		wait = max(1, min(wait, next_try - time.time()))
+	return wait
 
 def upload_file(filename):
 	logger.info("Uploading file {0}".format(filename))
@@ -30,16 +67,154 @@ def upload_file(filename):
 		TCMConstants.RCLONE_PATH, TCMConstants.UPLOAD_LOCAL_PATH,
 		filename, TCMConstants.UPLOAD_REMOTE_PATH)
 	logger.debug("Command: {0}".format(command))
+	try:
+		size = os.path.getsize(f"{TCMConstants.UPLOAD_LOCAL_PATH}{filename}")
+	except OSError:
+		size = 0
 	try:
 		completed = subprocess.run(command, shell=True, stdin=subprocess.DEVNULL,
 			stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 		if completed.stderr or completed.returncode != 0:
 			logger.error("Error running rclone command: {0}, returncode: {3}, stdout: {1}, stderr: {2}".format(
 				command, completed.stdout, completed.stderr, completed.returncode))
+			Metrics.inc("tcm_upload_files_total", result="failed")
 		else:
 			logger.info("Uploaded file {0}".format(filename))
-	except shutil.Error:
-		logger.error("Failed to upload {0}".format(filename))
+			Metrics.inc("tcm_upload_bytes_total", size)
+			Metrics.inc("tcm_upload_files_total", result="ok")
+	except OSError as e:
+		logger.error("Failed to upload {0}: {1}".format(filename, e))
+
+def upload_batch(queue, files, index=None):
+	Metrics.timed_call("tcm_open_files_scan_seconds", TCMConstants.refresh_open_files)
+	names = {}
+	for file in files:
+		path = f"{TCMConstants.UPLOAD_LOCAL_PATH}{file}"
+		try:
+			stat = os.stat(path)
+		except FileNotFoundError:
+			continue
+		if os.path.isdir(path):
+			# rclone moves the contents of a folder, which a file list can not express
+			upload_file(file)
+			continue
+		names[file] = (stat.st_size, stat.st_mtime_ns)
+	queue.refresh(names)
+	due = [file for file in queue.get_due(time.time()) if Metrics.timed_call("tcm_open_file_check_seconds", TCMConstants.check_file_for_read, f"{TCMConstants.UPLOAD_LOCAL_PATH}{file}")]
+	if index is not None:
+		due = [file for file in due if not upload_duplicate(queue, index, file)]
+		index.save()
+	if not due:
+		queue.save()
+		return
+
+	logger.info(f"Uploading {len(due)} files")
+	with tempfile.NamedTemporaryFile("w", prefix="upload-", suffix=".txt", delete=False) as file_list:
+		file_list.write("".join(f"{file}\n" for file in due))
+	queue.set_in_flight(due)
+	command = get_batch_command(file_list.name)
+	logger.debug(f"Command: {shlex.join(command)}")
+	completed = None
+	try:
+		completed = subprocess.run(command, stdin=subprocess.DEVNULL,
+			stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	except OSError as e:
+		logger.error(f"Unable to run rclone: {e}")
+	finally:
+		os.remove(file_list.name)
+	if completed is not None and (completed.stderr or completed.returncode != 0):
+		logger.error(f"Error running rclone command: {shlex.join(command)}, returncode: {completed.returncode}, stdout: {completed.stdout}, stderr: {completed.stderr}")
+
+	# rclone move removes each file it uploaded, so a file still here failed
+	for file in due:
+		if os.path.exists(f"{TCMConstants.UPLOAD_LOCAL_PATH}{file}"):
+			delay = queue.set_failed(file)
+			logger.error(f"Failed to upload {file}, will try again in {delay} seconds")
+			Metrics.inc("tcm_upload_files_total", result="failed")
+		else:
+			queue.set_done(file)
+			logger.info(f"Uploaded file {file}")
+			Metrics.inc("tcm_upload_bytes_total", queue.get_size(file))
+			Metrics.inc("tcm_upload_files_total", result="ok")
+			digest, md5 = queue.get_hash(file)
+			if index is not None and digest and md5:
+				index.add(digest, file, queue.get_size(file), md5)
+	queue.save()
+	if index is not None:
+		index.save()
+
+def upload_duplicate(queue, index, file):
+	# Returns True when the content of file is already on the remote and the
+	# local file has been removed, and False when it still has to be uploaded
+	path = f"{TCMConstants.UPLOAD_LOCAL_PATH}{file}"
+	size = queue.get_size(file)
+	digest, md5 = queue.get_hash(file)
+	if not digest or not md5:
+		try:
+			digest, md5 = UploadIndex.hash_file(path)
+		except OSError as e:
+			logger.error(f"Unable to hash {path}: {e}")
+			return False
+		queue.set_hash(file, digest, md5)
+	entry = index.get(digest, size)
+	if entry is None:
+		return False
+	original = entry["name"]
+	if entry.get("md5") != md5 or not remote_file_matches(original, size, md5):
+		logger.warning(f"Earlier upload {original} of the same content as {file} is not on the remote as it was, uploading {file}")
+		index.forget(digest)
+		return False
+
+	copied = TCMConstants.UPLOAD_DEDUP == 'copy' and original != file
+	if copied:
+		command = shlex.split(TCMConstants.RCLONE_PATH) + ['copyto', get_remote_path(original), get_remote_path(file)]
+		logger.debug(f"Command: {shlex.join(command)}")
+		try:
+			completed = subprocess.run(command, stdin=subprocess.DEVNULL,
+				stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		except OSError as e:
+			logger.error(f"Unable to run rclone: {e}")
+			return False
+		if completed.returncode != 0 or not remote_file_matches(file, size, md5):
+			logger.warning(f"Unable to copy {original} to {file} on the remote, uploading {file}: {completed.stderr}")
+			return False
+		index.add(digest, file, size, md5)
+
+	# Only removed once the remote is known to have the same content
+	try:
+		os.remove(path)
+	except OSError as e:
+		logger.error(f"Unable to remove {path} after finding it on the remote: {e}")
+		return False
+	queue.set_done(file)
+	logger.info(f"File {file} has the same content as the earlier upload {original}, {'copied it on the remote' if copied else 'skipped it'}")
+	Metrics.inc("tcm_upload_deduplicated_bytes_total", size)
+	Metrics.inc("tcm_upload_files_total", result="duplicate")
+	return True
+
+def remote_file_matches(name, size, md5):
+	# True only when rclone reports a file of this size and MD5 under name.
+	# A remote that can not give an MD5 never matches, so nothing is lost.
+	command = shlex.split(TCMConstants.RCLONE_PATH) + ['lsjson', '--hash', '--hash-type', 'md5', get_remote_path(name)]
+	logger.debug(f"Command: {shlex.join(command)}")
+	try:
+		completed = subprocess.run(command, stdin=subprocess.DEVNULL,
+			stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		items = json.loads(completed.stdout) if completed.returncode == 0 else []
+	except (OSError, ValueError) as e:
+		logger.error(f"Unable to check {name} on the remote: {e}")
+		return False
+	return any(not item.get("IsDir") and item.get("Size") == size and item.get("Hashes", {}).get("md5") == md5
+		for item in items)
+
+def get_remote_path(name):
+	remote = TCMConstants.UPLOAD_REMOTE_PATH
+	return f"{remote}{name}" if remote.endswith((":", "/")) else f"{remote}/{name}"
+
+def get_batch_command(file_list):
+	# --files-from-raw, as --files-from would take names starting with # or ; as comments
+	return shlex.split(TCMConstants.RCLONE_PATH) + ['move', TCMConstants.UPLOAD_LOCAL_PATH, TCMConstants.UPLOAD_REMOTE_PATH,
+		'--files-from-raw', file_list, '--transfers', str(TCMConstants.UPLOAD_TRANSFERS)]
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,80 @@
+# This module remembers the content hash of every file UploadDrive has
+# uploaded, saved in UPLOAD_INDEX_PATH. Files are hashed in fixed-size chunks
+# into one reused buffer, so memory use does not grow with the file size.
+# UploadDrive looks up each new file here before uploading it, and a file
+# whose content is already on the remote is not sent again. The MD5 of each
+# file is kept as well, as that is a hash rclone can check on the remote
+# before the local file is removed.
+
+import os
+import json
+import hashlib
+import logging
+import TCMConstants
+
+CHUNK_SIZE = 1024 * 1024
+
+class UploadIndex:
+
+	def __init__(self, state_path):
+		self.state_path = state_path
+		self.hashes = {}
+		self.changed = False
+		self.load()
+
+	def get(self, digest, size):
+		# Entry (name, size and md5) of an uploaded file with this content, or None
+		entry = self.hashes.get(digest)
+		if entry and entry["size"] == size:
+			return entry
+		return None
+
+	def add(self, digest, name, size, md5):
+		# An upload under the same name replaced whatever content was there
+		for other in [other for other, entry in self.hashes.items() if entry["name"] == name and other != digest]:
+			del self.hashes[other]
+		self.hashes[digest] = {"name" : name, "size" : size, "md5" : md5}
+		self.changed = True
+
+	def forget(self, digest):
+		if self.hashes.pop(digest, None):
+			self.changed = True
+
+	def load(self):
+		logger = logging.getLogger(TCMConstants.get_basename())
+		try:
+			with open(self.state_path, "r") as reader:
+				self.hashes = json.load(reader)
+		except FileNotFoundError:
+			return
+		except (OSError, ValueError) as e:
+			logger.warning(f"Unable to read upload index {self.state_path}, starting a new one: {e}")
+			self.hashes = {}
+
+	def save(self):
+		if not self.changed:
+			return
+		logger = logging.getLogger(TCMConstants.get_basename())
+		try:
+			with open(f"{self.state_path}.tmp", "w") as writer:
+				json.dump(self.hashes, writer)
+			os.replace(f"{self.state_path}.tmp", self.state_path)
+			self.changed = False
+		except OSError as e:
+			logger.error(f"Unable to save upload index {self.state_path}: {e}")
+
+def hash_file(path):
+	# Returns the BLAKE2b digest the index is keyed on and the MD5 for rclone,
+	# read in one pass
+	digest = hashlib.blake2b()
+	md5 = hashlib.md5()
+	buffer = bytearray(CHUNK_SIZE)
+	view = memoryview(buffer)
+	with open(path, "rb", buffering=0) as reader:
+		while True:
+			read = reader.readinto(buffer)
+			if not read:
+				break
+			digest.update(view[:read])
+			md5.update(view[:read])
+	return digest.hexdigest(), md5.hexdigest()
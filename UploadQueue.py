@@ -0,0 +1,112 @@
+# This module keeps the state of every file UploadDrive has seen in
+# UPLOAD_LOCAL_PATH, saved in UPLOAD_QUEUE_PATH so it survives a restart. A
+# file is pending until it is handed to rclone, in flight while rclone runs,
+# and then done (rclone moved it away) or failed. A failed file waits
+# UPLOAD_RETRY_DELAY seconds before it is tried again, twice as long after
+# every further failure up to UPLOAD_RETRY_MAX_DELAY, so a file rclone keeps
+# refusing is not retried in a tight loop.
+
+import os
+import json
+import time
+import logging
+import TCMConstants
+
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+
+# Seconds a done entry is kept, so a file that shows up again under the same
+# name is not mistaken for one that was already uploaded
+DONE_KEEP_SECONDS = 86400
+
+class UploadQueue:
+
+	def __init__(self, state_path):
+		self.state_path = state_path
+		self.files = {}
+		self.load()
+
+	def refresh(self, names):
+		# names maps each file now in UPLOAD_LOCAL_PATH to its (size, mtime)
+		now = time.time()
+		for name, signature in names.items():
+			entry = self.files.get(name)
+			if entry is None or entry["state"] == DONE or (entry["state"] != IN_FLIGHT and entry["signature"] != list(signature)):
+				self.files[name] = {"state" : PENDING, "signature" : list(signature), "attempts" : 0, "next_try" : 0, "updated" : now}
+		for name in list(self.files):
+			entry = self.files[name]
+			if name not in names and entry["state"] != DONE:
+				# Moved away by rclone, or removed by hand
+				self.set_done(name)
+			elif entry["state"] == DONE and now - entry["updated"] > DONE_KEEP_SECONDS:
+				del self.files[name]
+
+	def recover(self):
+		# Files in flight when UploadDrive stopped are sent again
+		for entry in self.files.values():
+			if entry["state"] == IN_FLIGHT:
+				entry["state"] = PENDING
+
+	def get_due(self, now):
+		return sorted(name for name, entry in self.files.items()
+			if entry["state"] in (PENDING, FAILED) and entry["next_try"] <= now)
+
+	def next_try(self):
+		times = [entry["next_try"] for entry in self.files.values() if entry["state"] == FAILED]
+		return min(times) if times else None
+
+	def set_in_flight(self, names):
+		for name in names:
+			self.files[name]["state"] = IN_FLIGHT
+			self.files[name]["updated"] = time.time()
+		self.save()
+
+	def set_done(self, name):
+		entry = self.files[name]
+		entry["state"] = DONE
+		entry["updated"] = time.time()
+
+	def set_failed(self, name):
+		entry = self.files[name]
+		entry["state"] = FAILED
+		entry["attempts"] += 1
+		entry["updated"] = time.time()
+		delay = min(TCMConstants.UPLOAD_RETRY_DELAY * 2 ** (entry["attempts"] - 1), TCMConstants.UPLOAD_RETRY_MAX_DELAY)
+		entry["next_try"] = entry["updated"] + delay
+		return delay
+
+	def get_size(self, name):
+		return self.files[name]["signature"][0]
+
+	def get_hash(self, name):
+		# Content hashes for UploadIndex, dropped with the entry when the file changes
+		return self.files[name].get("hash"), self.files[name].get("md5")
+
+	def set_hash(self, name, digest, md5):
+		self.files[name]["hash"] = digest
+		self.files[name]["md5"] = md5
+
+	def load(self):
+		logger = logging.getLogger(TCMConstants.get_basename())
+		try:
+			with open(self.state_path, "r") as reader:
+				self.files = json.load(reader)
+		except FileNotFoundError:
+			return
+		except (OSError, ValueError) as e:
+			logger.warning(f"Unable to read upload queue {self.state_path}, starting a new one: {e}")
+			self.files = {}
+			return
+		self.recover()
+		logger.info(f"Loaded upload queue with {len(self.files)} files")
+
+	def save(self):
+		logger = logging.getLogger(TCMConstants.get_basename())
+		try:
+			with open(f"{self.state_path}.tmp", "w") as writer:
+				json.dump(self.files, writer)
+			os.replace(f"{self.state_path}.tmp", self.state_path)
+		except OSError as e:
+			logger.error(f"Unable to save upload queue {self.state_path}: {e}")
@@ -0,0 +1,65 @@
+# This module provides a small bounded pool of worker threads. MergeTeslaCam
+# uses one pool per kind of encode so that hardware full merges and software
+# fast previews run side by side instead of queuing behind each other.
+# Jobs are started lowest priority first; jobs with the same priority start
+# in the order they were submitted.
+
+import threading
+import queue
+import itertools
+import logging
+import TCMConstants
+
+class WorkerPool:
+
+	def __init__(self, name, slots):
+		self.name = name
+		self.slots = max(1, slots)
+		self.jobs = queue.PriorityQueue()
+		self.sequence = itertools.count()
+		self.lock = threading.Lock()
+		self.queued_keys = set()
+		self.running_keys = set()
+		for i in range(self.slots):
+			worker = threading.Thread(target=self.work, name=f"{name}-{i}", daemon=True)
+			worker.start()
+
+	def submit(self, key, priority, function, *args):
+		with self.lock:
+			if key in self.queued_keys or key in self.running_keys:
+				return False
+			self.queued_keys.add(key)
+		self.jobs.put((priority, next(self.sequence), key, function, args))
+		return True
+
+	def has(self, key):
+		with self.lock:
+			return key in self.queued_keys or key in self.running_keys
+
+	def queued(self):
+		with self.lock:
+			return len(self.queued_keys)
+
+	def get_queued_keys(self):
+		with self.lock:
+			return list(self.queued_keys)
+
+	def in_flight(self):
+		with self.lock:
+			return len(self.running_keys)
+
+	def work(self):
+		logger = logging.getLogger(TCMConstants.get_basename())
+		while True:
+			priority, sequence, key, function, args = self.jobs.get()
+			with self.lock:
+				self.queued_keys.discard(key)
+				self.running_keys.add(key)
+			try:
+				function(*args)
+			except Exception as e:
+				logger.error(f"{self.name} job {key} failed: {e}")
+			finally:
+				with self.lock:
+					self.running_keys.discard(key)
+				self.jobs.task_done()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+# Runs UploadDrive's batch upload against a local directory as the remote
+# (rclone's local backend), so it can be checked without Google Drive. It
+# covers a normal batch, a file that keeps failing (with its retry delay
+# doubling and no retry before it is due), a file that was in flight
+# when UploadDrive stopped being sent again after a restart, and files with
+# the same content as an earlier upload (UPLOAD_DEDUP 'skip' and 'copy',
+# and an earlier upload that is gone from the remote or was changed there).
+# Usage, from anywhere: python3 tools/check_upload_batch.py [path to rclone]
+# Everything is done in a temporary directory that is removed at the end.
+# The exit code is 0 when all checks pass.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import TCMConstants
+
+failures = 0
+
+def check(description, passed):
+	global failures
+	print(f"{'PASS' if passed else 'FAIL'}: {description}")
+	if not passed:
+		failures += 1
+
+def make_file(name, size=1000, content=None):
+	with open(f"{TCMConstants.UPLOAD_LOCAL_PATH}{name}", "wb") as writer:
+		writer.write(os.urandom(size) if content is None else content)
+
+def read_file(path):
+	try:
+		with open(path, "rb") as reader:
+			return reader.read()
+	except OSError:
+		return None
+
+def main():
+	rclone = sys.argv[1] if len(sys.argv) > 1 else shutil.which("rclone")
+	if not rclone:
+		print("rclone not found, pass its path as the first argument")
+		sys.exit(2)
+
+	work = tempfile.mkdtemp(prefix="tcm-upload-check-")
+	remote = f"{work}/remote"
+	TCMConstants.LOG_PATH = f"{work}/log/"
+	TCMConstants.UPLOAD_LOCAL_PATH = f"{work}/upload/"
+	TCMConstants.UPLOAD_REMOTE_PATH = remote
+	TCMConstants.UPLOAD_QUEUE_PATH = f"{work}/upload-queue.json"
+	TCMConstants.UPLOAD_INDEX_PATH = f"{work}/upload-index.json"
+	TCMConstants.RCLONE_PATH = f"{rclone} --log-file {work}/log/rclone.log"
+	TCMConstants.METRICS_PATH = None
+	for path in (TCMConstants.LOG_PATH, TCMConstants.UPLOAD_LOCAL_PATH, remote):
+		os.makedirs(path)
+
+	# UploadDrive sets up its log file when it is imported
+	import UploadDrive
+	import UploadQueue
+	import UploadIndex
+	try:
+		check_batch(UploadDrive, UploadQueue, remote)
+		check_backoff(UploadDrive, UploadQueue, remote)
+		check_recovery(UploadDrive, UploadQueue, remote)
+		check_dedup(UploadDrive, UploadQueue, UploadIndex, remote)
+	finally:
+		shutil.rmtree(work, ignore_errors=True)
+	print(f"{failures} checks failed" if failures else "All checks passed")
+	sys.exit(1 if failures else 0)
+
+def check_batch(UploadDrive, UploadQueue, remote):
+	queue = UploadQueue.UploadQueue(TCMConstants.UPLOAD_QUEUE_PATH)
+	names = ["2024-01-01_10-00-00-full.mp4", "2024-01-01_10-01-00-full.mp4", "#2024-01-01 10-02-00;fast.mp4"]
+	for name in names:
+		make_file(name)
+	UploadDrive.upload_batch(queue, os.listdir(TCMConstants.UPLOAD_LOCAL_PATH))
+	check("a batch moves every file to the remote", all(os.path.isfile(f"{remote}/{name}") for name in names))
+	check("a batch leaves nothing behind locally", not os.listdir(TCMConstants.UPLOAD_LOCAL_PATH))
+	check("uploaded files are done in the queue", all(queue.files[name]["state"] == UploadQueue.DONE for name in names))
+
+def check_backoff(UploadDrive, UploadQueue, remote):
+	queue = UploadQueue.UploadQueue(TCMConstants.UPLOAD_QUEUE_PATH)
+	name = "2024-01-01_11-00-00-full.mp4"
+	make_file(name)
+	# A directory with the same name on the remote makes rclone refuse the file
+	os.makedirs(f"{remote}/{name}")
+	UploadDrive.upload_batch(queue, os.listdir(TCMConstants.UPLOAD_LOCAL_PATH))
+	entry = queue.files[name]
+	check("a failed upload stays local", os.path.isfile(f"{TCMConstants.UPLOAD_LOCAL_PATH}{name}"))
+	check("a failed upload is marked failed", entry["state"] == UploadQueue.FAILED and entry["attempts"] == 1)
+	first_delay = entry["next_try"] - entry["updated"]
+	check("the first retry waits UPLOAD_RETRY_DELAY", abs(first_delay - TCMConstants.UPLOAD_RETRY_DELAY) < 1)
+
+	UploadDrive.upload_batch(queue, os.listdir(TCMConstants.UPLOAD_LOCAL_PATH))
+	check("a failed upload is not retried before it is due", queue.files[name]["attempts"] == 1)
+	check("UploadDrive wakes up for the retry", UploadDrive.get_wait_time(queue) <= TCMConstants.UPLOAD_RETRY_DELAY)
+
+	# Pretend the delay has passed
+	entry["next_try"] = 0
+	UploadDrive.upload_batch(queue, os.listdir(TCMConstants.UPLOAD_LOCAL_PATH))
+	entry = queue.files[name]
+	second_delay = entry["next_try"] - entry["updated"]
+	check("a second failure doubles the delay", entry["attempts"] == 2 and abs(second_delay - 2 * first_delay) < 1)
+
+	os.rmdir(f"{remote}/{name}")
+	entry["next_try"] = 0
+	UploadDrive.upload_batch(queue, os.listdir(TCMConstants.UPLOAD_LOCAL_PATH))
+	check("a retry that works moves the file", os.path.isfile(f"{remote}/{name}") and queue.files[name]["state"] == UploadQueue.DONE)
+
+def check_recovery(UploadDrive, UploadQueue, remote):
+	name = "2024-01-01_12-00-00-full.mp4"
+	make_file(name)
+	queue = UploadQueue.UploadQueue(TCMConstants.UPLOAD_QUEUE_PATH)
+	stat = os.stat(f"{TCMConstants.UPLOAD_LOCAL_PATH}{name}")
+	queue.refresh({name : (stat.st_size, stat.st_mtime_ns)})
+	# Saved as in flight, as if UploadDrive stopped while rclone was running
+	queue.set_in_flight([name])
+
+	restarted = UploadQueue.UploadQueue(TCMConstants.UPLOAD_QUEUE_PATH)
+	check("a file in flight at a restart is pending again", restarted.files[name]["state"] == UploadQueue.PENDING)
+	check("a file in flight at a restart is due right away", name in restarted.get_due(time.time()))
+	UploadDrive.upload_batch(restarted, os.listdir(TCMConstants.UPLOAD_LOCAL_PATH))
+	check("a file in flight at a restart is uploaded", os.path.isfile(f"{remote}/{name}") and restarted.files[name]["state"] == UploadQueue.DONE)
+
+def check_dedup(UploadDrive, UploadQueue, UploadIndex, remote):
+	queue = UploadQueue.UploadQueue(TCMConstants.UPLOAD_QUEUE_PATH)
+	index = UploadIndex.UploadIndex(TCMConstants.UPLOAD_INDEX_PATH)
+	def upload():
+		UploadDrive.upload_batch(queue, os.listdir(TCMConstants.UPLOAD_LOCAL_PATH), index)
+	content = os.urandom(1000)
+	make_file("2024-01-02_10-00-00-full.mp4", content=content)
+	upload()
+	digest = UploadIndex.hash_file(f"{remote}/2024-01-02_10-00-00-full.mp4")[0]
+	check("an upload is recorded in the index", (index.get(digest, 1000) or {}).get("name") == "2024-01-02_10-00-00-full.mp4")
+
+	TCMConstants.UPLOAD_DEDUP = 'skip'
+	make_file("2024-01-02_10-01-00-full.mp4", content=content)
+	upload()
+	check("skip removes a duplicate locally", not os.path.exists(f"{TCMConstants.UPLOAD_LOCAL_PATH}2024-01-02_10-01-00-full.mp4"))
+	check("skip does not put a duplicate on the remote", not os.path.exists(f"{remote}/2024-01-02_10-01-00-full.mp4"))
+	check("skip marks a duplicate done", queue.files["2024-01-02_10-01-00-full.mp4"]["state"] == UploadQueue.DONE)
+
+	TCMConstants.UPLOAD_DEDUP = 'copy'
+	make_file("2024-01-02_10-02-00-full.mp4", content=content)
+	upload()
+	check("copy removes a duplicate locally", not os.path.exists(f"{TCMConstants.UPLOAD_LOCAL_PATH}2024-01-02_10-02-00-full.mp4"))
+	check("copy puts the same content on the remote under the new name", read_file(f"{remote}/2024-01-02_10-02-00-full.mp4") == content)
+
+	# The earlier upload is gone from the remote: the file is uploaded and the index points at it
+	for name in os.listdir(remote):
+		if name.startswith("2024-01-02_"):
+			os.remove(f"{remote}/{name}")
+	make_file("2024-01-02_10-03-00-full.mp4", content=content)
+	upload()
+	check("a duplicate of an upload gone from the remote is uploaded", read_file(f"{remote}/2024-01-02_10-03-00-full.mp4") == content)
+	check("the index points at the new upload", index.get(digest, 1000)["name"] == "2024-01-02_10-03-00-full.mp4")
+
+	# The earlier upload was changed on the remote (same size, other content)
+	with open(f"{remote}/2024-01-02_10-03-00-full.mp4", "wb") as writer:
+		writer.write(os.urandom(1000))
+	make_file("2024-01-02_10-04-00-full.mp4", content=content)
+	upload()
+	check("a duplicate of an upload changed on the remote is uploaded", read_file(f"{remote}/2024-01-02_10-04-00-full.mp4") == content)
+	check("the index points at the upload that matches", index.get(digest, 1000)["name"] == "2024-01-02_10-04-00-full.mp4")
+
+	# A new upload under the same name replaces the content the index had for it
+	make_file("2024-01-02_10-04-00-full.mp4")
+	upload()
+	check("an upload under the same name drops the old content from the index", index.get(digest, 1000) is None)
+	TCMConstants.UPLOAD_DEDUP = None
+
+if __name__ == '__main__':
+	main()